@@ -1,16 +1,67 @@
 import cv2
 import time
 import pygame
+import threading
 import numpy as np
 
 from djitellopy.tello import Tello
 from ps3_inputs import ControllerEvents, PS3ControllerManager
-from peeptree.processing import ImageProcessor
+from peeptree.processing import ImageProcessor, LatencyRecorder, TrunkTracker
 
 # Speed of the drone
 # Frames per second of the pygame window display
+# Number of threads classifying the captured frames
+# Stage latency dump of every inference thread (.csv or .json, None = no instrumentation)
+# Classifier score above which a block is detected (lower = higher recall and more false positives)
+# Weight of the current frame in the block score average (None = no smoothing)
+# Number of frames between classified frames (the trunk tracks are extrapolated in between, 1 = every frame)
+# (smoothing and tracking are stateful, they require a single inference thread)
 S = 60
 FPS = 25
+N_INFERENCE_WORKERS = 1
+LATENCY_DUMP_TEMPLATE = None
+DECISION_THRESHOLD = 0.0
+SCORE_SMOOTHING = None
+DETECTION_INTERVAL = 1
+TRACKING = SCORE_SMOOTHING is not None or DETECTION_INTERVAL > 1
+
+
+class LatestValueQueue(object):
+
+    """ 
+    Single slot queue connecting the pipeline stages.
+    A new value replaces the stale one, so producers never block and consumers always get the most recent value.
+    """
+
+    def __init__(self):
+
+        self.condition = threading.Condition()
+        self.value = None
+        self.has_value = False
+
+
+    def put(self, value):
+
+        """ Stores the value, dropping the one not consumed yet """
+
+        with self.condition:
+            self.value = value
+            self.has_value = True
+            self.condition.notify()
+
+
+    def get(self, timeout=None):
+
+        """ 
+        Returns the latest value and empties the slot
+        Returns None when no value is available before the timeout (in seconds)
+        """
+
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.has_value, timeout):
+                return None
+            self.has_value = False
+            return self.value
 
 
 class FrontEnd(object):
@@ -47,6 +98,11 @@ class FrontEnd(object):
 
         self.send_rc_control = False
 
+        # defining the pipeline stage connections (capture -> inference -> display)
+        self.frame_queue = LatestValueQueue()
+        self.detection_queue = LatestValueQueue()
+        self.stop_event = threading.Event()
+
         # creating a user event every 50 milliseconds (for updating)
         pygame.time.set_timer(pygame.USEREVENT + 1, 50)
 
@@ -55,6 +111,11 @@ class FrontEnd(object):
 
         ''' Tello control entry point '''
 
+        # the frames are shared by the inference threads, a tracker must see all the processed frames
+        if TRACKING and N_INFERENCE_WORKERS > 1:
+            print("Score smoothing and tracking require a single inference thread")
+            return
+
         # setting up the Tello for run
         if not self.tello.connect():
             print("Tello not connected")
@@ -74,8 +135,21 @@ class FrontEnd(object):
 
         crtl_manager = PS3ControllerManager()
         frame_read = self.tello.get_frame_read()
-        processor = ImageProcessor("peeptree/classifier.pickle", block_size=20)
 
+        # launching the capture and inference stages
+        stage_threads = [threading.Thread(target=self.capture_frames, args=(frame_read,), daemon=True)]
+        latency_recorders = []
+        for _ in range(N_INFERENCE_WORKERS):
+            latency_recorder = LatencyRecorder() if LATENCY_DUMP_TEMPLATE is not None else None
+            processor = ImageProcessor("peeptree/classifier.npz", block_size=20, decision_threshold=DECISION_THRESHOLD,
+                                       score_smoothing=SCORE_SMOOTHING, latency_recorder=latency_recorder)
+            tracker = TrunkTracker(processor, detection_interval=DETECTION_INTERVAL) if TRACKING else None
+            stage_threads.append(threading.Thread(target=self.process_frames, args=(processor, tracker), daemon=True))
+            latency_recorders.append(latency_recorder)
+        for stage_thread in stage_threads:
+            stage_thread.start()
+
+        displayed_frame_i = -1
         should_stop = False
         while not should_stop:
 
@@ -107,32 +181,81 @@ class FrontEnd(object):
                 frame_read.stop()
                 break
 
-            if capture_counter == 5:
-
-            # getting latest video frae from the drone
-            # the "getter" for the frames is the call to "frame_read.frame"
-            self.screen.fill([0, 0, 0])
-            frame = cv2.cvtColor(frame_read.frame, cv2.COLOR_BGR2RGB)
-
-            # processing the latest frame
-            try:
-                frame = processor.detect_object_segments(frame)
-            except : print("error processing frame")
-            
-            # displaying the latest frame
-            frame = np.rot90(frame)
-            frame = np.flipud(frame)
-            frame = pygame.surfarray.make_surface(frame)
-            self.screen.blit(frame, (0, 0))
-            pygame.display.update()
+            # displaying the latest detection (results older than the displayed one are dropped, 
+            # only the displayed results are drawn, the tracked trunks replace the detected blocks when tracking)
+            detection = self.detection_queue.get(timeout=0)
+            if detection is not None and detection[0] > displayed_frame_i:
+                displayed_frame_i, detection_result = detection
+                frame = detection_result.render(draw_segments=not TRACKING, draw_trunks=TRACKING)
+                self.screen.fill([0, 0, 0])
+                frame = np.rot90(frame)
+                frame = np.flipud(frame)
+                frame = pygame.surfarray.make_surface(frame)
+                self.screen.blit(frame, (0, 0))
+                pygame.display.update()
 
             # main control loop is limited by FPS
             time.sleep(1 / FPS)
 
+        # stopping the capture and inference stages
+        self.stop_event.set()
+        for stage_thread in stage_threads:
+            stage_thread.join()
+
+        # exporting the stage latencies of every inference thread
+        for worker_i, latency_recorder in enumerate(latency_recorders):
+            if latency_recorder is not None:
+                latency_recorder.dump(LATENCY_DUMP_TEMPLATE.format(worker_i))
+
         # deallocating control resources
         self.tello.end()
 
 
+    def capture_frames(self, frame_read):
+
+        """ 
+        Capture stage, publishes the latest video frame from the drone
+        Arguments:
+            frame_read: Tello frame reader
+        """
+
+        frame_i = 0
+        while not self.stop_event.is_set() and not frame_read.stopped:
+
+            # the "getter" for the frames is the call to "frame_read.frame"
+            frame = cv2.cvtColor(frame_read.frame, cv2.COLOR_BGR2RGB)
+            self.frame_queue.put((frame_i, frame))
+            frame_i += 1
+
+            time.sleep(1 / FPS)
+
+
+    def process_frames(self, processor, tracker):
+
+        """ 
+        Inference stage, applies the trunk detection (or tracking) to the latest captured frame
+        Arguments:
+            processor: image processor owned by the worker
+            tracker: trunk tracker wrapping the processor (None = no tracking)
+        """
+
+        while not self.stop_event.is_set():
+
+            # waiting for a new frame (checking for the stop event periodically)
+            capture = self.frame_queue.get(timeout=0.1)
+            if capture is None:
+                continue
+
+            frame_i, frame = capture
+            try:
+                detection_result = tracker.update(frame) if tracker is not None else processor.detect(frame)
+            except :
+                print("error processing frame")
+                continue
+
+            self.detection_queue.put((frame_i, detection_result))
+
+
     def keydown(self, key):
 
         """ 
@@ -0,0 +1,71 @@
+''' 
+Entry point script for comparing the exact polynomial SVM with the approximated kernel backend
+Both pipelines are trained on the same data, then compared on per-frame latency and recall
+'''
+
+import json
+import time
+
+import numpy as np
+from sklearn.metrics import recall_score, precision_score
+from sklearn.model_selection import train_test_split
+
+from peeptree.data import TrainingDataLoader
+from peeptree.model import TreeClassifierSVM, TreeClassifierApproxSVM
+
+
+if __name__ == "__main__":
+
+    # defining necessary paths
+    pipeline_config_path = "pipeline_params.json"
+    class_definitions_path = "predefined_classes.txt"
+    training_folder_prefix = "/home/one_wizard_boi/Documents/Projects/DJI-tree-detection/TrainingData/LabeledData_"
+
+    # defining the benchmark config
+    resized_width = 320
+    resized_height = 240
+    n_timed_frames = 50
+
+    # loading the wanted pipeline parameters
+    with open(pipeline_config_path) as config_file_h:
+        clf_params = json.load(config_file_h)
+
+    # loading and splitting the training data
+    image_size = clf_params["input_img_size"]
+    data_loader = TrainingDataLoader(training_folder_prefix + str(image_size), class_definitions_path, 
+                                     color_space=clf_params["feature_extractor__color_space"], random_state=0)
+    X, y = data_loader.load_training_data()
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, stratify=y, random_state=0)
+
+    # defining the compared pipelines
+    clf_pipelines = {
+        "exact svm" : TreeClassifierSVM.classification_pipeline(**clf_params),
+        "approx svm" : TreeClassifierApproxSVM.classification_pipeline(**clf_params)
+    }
+
+    # a frame is classified as a single batch of blocks
+    n_frame_blocks = (resized_width // image_size) * (resized_height // image_size)
+    frame_blocks = X_test[np.arange(n_frame_blocks) % X_test.shape[0]]
+
+    for clf_name, clf_pipeline in clf_pipelines.items():
+
+        # training the pipeline
+        start_time = time.perf_counter()
+        clf_pipeline.fit(X_train, y_train)
+        training_time = time.perf_counter() - start_time
+
+        # measuring the per-frame latency
+        frame_latencies = []
+        for _ in range(n_timed_frames):
+            start_time = time.perf_counter()
+            clf_pipeline.predict(frame_blocks)
+            frame_latencies.append(time.perf_counter() - start_time)
+
+        # measuring the classification performance
+        y_pred = clf_pipeline.predict(X_test)
+
+        print("\n{}".format(clf_name))
+        print("training time (s) : {:.3f}".format(training_time))
+        print("frame latency (ms) : median {:.2f}, p95 {:.2f} ({} blocks)".format(
+            1000 * np.median(frame_latencies), 1000 * np.percentile(frame_latencies, 95), n_frame_blocks))
+        print("recall : {:.4f}, precision : {:.4f}".format(recall_score(y_test, y_pred), precision_score(y_test, y_pred)))
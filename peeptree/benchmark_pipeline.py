@@ -0,0 +1,243 @@
+'''
+Entry point script for benchmarking the feature extraction, frame detection and training data loading throughputs
+Synthetic blocks, frames and classifiers are used (no dataset needed), the results are written to a JSON file
+named after the current commit, so that the throughputs can be compared between commits
+'''
+
+import os
+import sys
+import json
+import time
+import pickle
+import os.path
+import platform
+import tempfile
+import itertools
+import subprocess
+
+import cv2 as cv
+import numpy as np
+
+from peeptree.data import TrainingDataLoader, PackedDatasetWriter
+from peeptree.model import TreeClassifierSVM, ImageFeatureExtractor
+from peeptree.processing import ImageProcessor
+
+# defining the output path (formatted with the current commit)
+results_path_template = "benchmark_results_{0}.json"
+
+# defining the feature extraction benchmark
+extractor_grid = {
+    "channel_hist_n_bins" : [10, 15, 20],
+    "lbp_n_points" : [8, 10],
+    "lbp_radius" : [1, 3],
+    "fusion_method" : [1, 2]
+}
+batch_sizes = [1, 64, 192, 1024]
+extraction_block_size = 20
+
+# defining the frame detection benchmark
+detection_block_sizes = [15, 20, 25, 30]
+frame_height = 480
+frame_width = 640
+n_frames = 30
+
+# defining the loading benchmark
+dataset_sizes = [500, 2000, 8000]
+
+# defining the number of timed runs of every measure
+n_repeats = 5
+random_seed = 0
+
+
+def synthetic_blocks(rng, n_blocks, block_size):
+
+    '''
+    Generates labeled training blocks, the trunk blocks (label 1) being darker with vertical stripes
+
+    Returns
+    -------
+    (numpy.ndarray (4D), numpy.ndarray (1D)) : blocks (n_blocks, block_size, block_size, 3) and labels
+    '''
+
+    X = rng.integers(0, 256, (n_blocks, block_size, block_size, 3), dtype=np.uint8)
+    y = rng.integers(0, 2, n_blocks)
+
+    X[y == 1] //= 2
+    X[y == 1, :, ::3] = 30
+
+    return X, y
+
+
+def synthetic_frame(rng):
+
+    ''' Generates a frame of random background with a few trunk-like vertical bands '''
+
+    frame = rng.integers(0, 256, (frame_height, frame_width, 3), dtype=np.uint8)
+    for band_start in rng.integers(0, frame_width - 40, 3):
+        frame[:, band_start : band_start + 40] //= 2
+
+    return frame
+
+
+def time_runs(function, n_runs):
+
+    ''' Returns the duration (in seconds) of every run of the provided function '''
+
+    durations = []
+    for _ in range(n_runs):
+        start_time = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start_time)
+
+    return durations
+
+
+def summarize(durations, n_items):
+
+    ''' Summarizes run durations (in seconds) and the corresponding throughput (items / s) '''
+
+    median = float(np.median(durations))
+    return {
+        "median_s" : median,
+        "p95_s" : float(np.percentile(durations, 95)),
+        "min_s" : float(np.min(durations)),
+        "throughput" : n_items / median if median > 0 else None
+    }
+
+
+def benchmark_transform(rng):
+
+    ''' Measures the ImageFeatureExtractor.transform throughput (images / s) for every extractor config and batch size '''
+
+    X, _ = synthetic_blocks(rng, max(batch_sizes), extraction_block_size)
+    param_names = sorted(extractor_grid.keys())
+
+    results = []
+    for param_values in itertools.product(*[extractor_grid[name] for name in param_names]):
+
+        extractor = ImageFeatureExtractor(**dict(zip(param_names, param_values)))
+        for batch_size in batch_sizes:
+            durations = time_runs(lambda: extractor.transform(X[: batch_size]), n_repeats)
+            results.append(dict(params=dict(zip(param_names, param_values)), batch_size=batch_size,
+                                **summarize(durations, batch_size)))
+
+    return results
+
+
+def benchmark_detection(rng, work_folder):
+
+    ''' Measures the detection throughput (frames / s) for every block size, with (detect_object_segments) and without (detect) rendering '''
+
+    frames = [synthetic_frame(rng) for _ in range(n_frames)]
+
+    results = []
+    for block_size in detection_block_sizes:
+
+        # training a classifier for the block size
+        X, y = synthetic_blocks(rng, 1000, block_size)
+        clf_pipeline = TreeClassifierSVM.classification_pipeline(svm__kernel="poly", svm__C=100, svm__degree=3)
+        clf_pipeline.fit(X, y)
+
+        clf_path = os.path.join(work_folder, "classifier_{0}.pickle".format(block_size))
+        with open(clf_path, 'wb') as handle:
+            pickle.dump(clf_pipeline, handle)
+
+        # timing the processing of all the frames
+        processor = ImageProcessor(clf_path, block_size=block_size)
+        detection_modes = {"rendered" : processor.detect_object_segments, "headless" : processor.detect}
+        for mode, detection_function in detection_modes.items():
+            durations = time_runs(lambda: [detection_function(frame) for frame in frames], n_repeats)
+            results.append(dict(block_size=block_size, mode=mode, n_blocks=processor.n_blocks_row * processor.n_blocks_col,
+                                **summarize(durations, len(frames))))
+
+    return results
+
+
+def benchmark_loading(rng, work_folder):
+
+    ''' Measures the TrainingDataLoader.load_training_data duration for every dataset size and storage format '''
+
+    class_def_path = os.path.join(work_folder, "classes.txt")
+    with open(class_def_path, "w") as class_file_h:
+        class_file_h.write("background\ntrunk\n")
+    label_names = ["background", "trunk"]
+
+    results = []
+    for dataset_size in dataset_sizes:
+
+        X, y = synthetic_blocks(rng, dataset_size, extraction_block_size)
+
+        # writing the dataset as image files and as a packed dataset
+        png_folder = os.path.join(work_folder, "png_{0}".format(dataset_size))
+        packed_folder = os.path.join(work_folder, "packed_{0}".format(dataset_size))
+        os.makedirs(png_folder)
+        dataset_writer = PackedDatasetWriter(packed_folder, extraction_block_size)
+        for image_i, (image, label) in enumerate(zip(X, y)):
+            cv.imwrite(os.path.join(png_folder, "image_{0}_{1}.png".format(image_i, label_names[label])), image)
+            dataset_writer.append(image, label_names[label], "image", (0, 0))
+        dataset_writer.close()
+
+        # the cached format is timed once the cache is filled
+        cache_folder = os.path.join(work_folder, "cache_{0}".format(dataset_size))
+        TrainingDataLoader(png_folder, class_def_path, cache_folder=cache_folder).load_training_data()
+
+        data_loaders = {
+            "png" : TrainingDataLoader(png_folder, class_def_path),
+            "png_cached" : TrainingDataLoader(png_folder, class_def_path, cache_folder=cache_folder),
+            "packed" : TrainingDataLoader(packed_folder, class_def_path)
+        }
+
+        for storage_format, data_loader in data_loaders.items():
+            durations = time_runs(data_loader.load_training_data, n_repeats)
+            results.append(dict(dataset_size=dataset_size, storage_format=storage_format,
+                                **summarize(durations, dataset_size)))
+
+    return results
+
+
+def current_commit():
+
+    ''' Returns the hash of the current commit (None outside of a git repository) '''
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+
+    rng = np.random.default_rng(random_seed)
+    commit = current_commit()
+
+    benchmark_results = {
+        "commit" : commit,
+        "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python" : sys.version.split()[0],
+        "numpy" : np.__version__,
+        "opencv" : cv.__version__,
+        "platform" : platform.platform(),
+        "n_cores" : os.cpu_count(),
+        "n_repeats" : n_repeats
+    }
+
+    with tempfile.TemporaryDirectory() as work_folder:
+
+        print("Benchmarking feature extraction ...")
+        benchmark_results["transform"] = benchmark_transform(rng)
+
+        print("Benchmarking frame detection ...")
+        benchmark_results["detection"] = benchmark_detection(rng, work_folder)
+
+        print("Benchmarking training data loading ...")
+        benchmark_results["loading"] = benchmark_loading(rng, work_folder)
+
+    # exporting the results
+    results_path = results_path_template.format(commit if commit is not None else "local")
+    with open(results_path, "w") as results_file:
+        json.dump(benchmark_results, results_file, indent=2)
+
+    for record in benchmark_results["detection"]:
+        print("block size {0} ({1}) : {2:.1f} frames / s".format(record["block_size"], record["mode"], record["throughput"]))
+    print("Benchmark results written to : ", results_path)
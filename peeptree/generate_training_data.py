@@ -1,6 +1,7 @@
 '''
 Entry point script for generating training images from the original segmented images 
 stored in the "SegmentedImages" folder.
+Every source image is decoded and resized once for all the image sizes.
 '''
 
 import os
@@ -18,6 +19,13 @@ if __name__ == "__main__":
     # defining the different image sizes to generate
     image_sizes = [15, 20, 25, 30]
 
+    # writing packed datasets instead of individual image files
+    packed_output = True
+
+    # defining the number of processes between which the annotation files are distributed
+    n_workers = os.cpu_count()
+
+    target_folders = {}
     for image_size in image_sizes:
 
         # creating the target folder
@@ -25,9 +33,12 @@ if __name__ == "__main__":
         if os.path.isdir(target_folder):
             shutil.rmtree(target_folder)
         os.mkdir(target_folder)
+        target_folders[image_size] = target_folder
 
-        print("Generating training images with dimensions : {0} X {0}.".format(str(image_size)))
+    print("Generating training images with dimensions : {}.".format(", ".join(
+        "{0} X {0}".format(str(image_size)) for image_size in image_sizes)))
 
-        # generating training data for current format
-        data_generator = TrainingDataGenerator(src_folder, target_folder, block_dim=image_size)
-        data_generator.generate_training_images()
\ No newline at end of file
+    # generating training data for all the formats
+    data_generator = TrainingDataGenerator(src_folder, target_folders[image_sizes[0]], block_dim=image_sizes[0], 
+                                           packed=packed_output, n_workers=n_workers)
+    data_generator.generate_multi_size_training_images(target_folders)
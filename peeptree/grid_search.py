@@ -1,14 +1,17 @@
-''' Entry point script for performing parameter gridsearchs '''
+'''
+Entry point script for performing parameter gridsearchs
+The features are extracted once per feature extractor configuration and the classifier fits
+are distributed to worker processes, the results are appended to a file (an interrupted search resumes from it)
+In "halving" mode, the candidates are evaluated on growing subsamples of the training data, the worst being discarded early
+'''
 
 import json
 import pickle
 
 from peeptree.model import TreeClassifierKNN, TreeClassifierSVM
 from peeptree.data import TrainingDataLoader
-from sklearn.model_selection import GridSearchCV
-from sklearn.metrics import accuracy_score, recall_score
+from peeptree.search import CachedGridSearch, HalvingGridSearch
 
-from sklearn.externals.joblib import parallel_backend
 
 if __name__ == "__main__":
 
@@ -16,9 +19,15 @@ if __name__ == "__main__":
     image_sizes = [15, 20]
     color_spaces = ["RGB", "HSV"]
 
+    # defining the search mode ("grid" = exhaustive, "halving" = successive halving)
+    search_mode = "grid"
+    halving_factor = 3
+
     # defining the necessary paths
     results_path_template = "search_results_{0}_{1}.pickle"
+    partial_results_path_template = "search_results_{0}_{1}_{2}.jsonl"
     param_grid_path = "grid_search_params.json"
+    feature_cache_folder = "feature_cache"
     class_definitions_path = "predefined_classes.txt"
     training_folder_prefix = "/home/one_wizard_boi/Documents/Projects/DJI-tree-detection/TrainingData/LabeledData_"
 
@@ -34,20 +43,23 @@ if __name__ == "__main__":
 
             # loading training data
             training_folder_path = training_folder_prefix + str(image_size)
-            data_loader = TrainingDataLoader(training_folder_path, class_definitions_path, color_space=color_space)
+            data_loader = TrainingDataLoader(training_folder_path, class_definitions_path, color_space=color_space,
+                                             cache_folder=feature_cache_folder, random_state=0)
             X, y = data_loader.load_training_data()
 
             # defining the correct color space in the param grid
-            param_grid["feature_extractor__color_space"] = [color_space]
+            param_grid["svm"]["feature_extractor__color_space"] = [color_space]
 
-            # defining the grid search
-            clf_pipeline = TreeClassifierSVM.classification_pipeline()
-            g_search = GridSearchCV(estimator=clf_pipeline, param_grid=param_grid["svm"], 
-                                    scoring="recall", n_jobs=3, cv=3, verbose=10)
-            
-            # performing the grid search and exporting the results
-            with parallel_backend('threading'):
-                g_search.fit(X, y)
+            # performing the search (resuming from the partial results) and exporting the results
+            partial_results_path = partial_results_path_template.format(image_size, color_space, search_mode)
+            if search_mode == "halving":
+                g_search = HalvingGridSearch(TreeClassifierSVM, param_grid["svm"], partial_results_path,
+                                             feature_cache_folder, scoring="recall", cv=3, factor=halving_factor)
+            else:
+                g_search = CachedGridSearch(TreeClassifierSVM, param_grid["svm"], partial_results_path,
+                                            feature_cache_folder, scoring="recall", cv=3)
+            g_search.fit(X, y)
+            print("Best parameters : ", g_search.best_params_, " - score : ", g_search.best_score_)
 
             with open(results_path_template.format(image_size, color_space), 'wb') as handle:
-                pickle.dump(g_search.cv_results_, handle)
\ No newline at end of file
+                pickle.dump(g_search.cv_results_, handle)
@@ -1,12 +1,14 @@
 import os
+import json
 import os.path
+import hashlib
 import logging
+import functools
+import multiprocessing
 import logging.handlers
 
 import xml.etree.ElementTree as ET
 
-import math
-import random
 import cv2 as cv
 import numpy as np
 
@@ -21,7 +23,8 @@ class TrainingDataGenerator():
     resized_width = 320
     resized_height = 240
 
-    def __init__(self, scr_folder, target_folder, block_dim=20, debug=False):
+    def __init__(self, scr_folder, target_folder, block_dim=20, packed=False, n_workers=1, 
+                 unlabeled_label=None, debug=False):
 
         ''' 
         Inputs
@@ -29,16 +32,23 @@ class TrainingDataGenerator():
         src_folder (str) : folder containing the labelled data files and the original images
         target_folder (str) : folder in which to create training images
         block_dim (int) : size (in pixels) of the training images (square images) 
+        packed (boolean) : True = write the training images as a packed dataset (see "PackedDataset")
+        n_workers (int) : number of processes between which the annotation files are distributed
+        unlabeled_label (str) : when defined, the blocks covered by no labelled object are also cut with this label
         debug (boolean) : True = display the training cutouts made from the manual segmentation
         '''
 
         self.src_folder = scr_folder
         self.target_folder = target_folder
+        self.packed = packed
+        self.n_workers = n_workers
+        self.unlabeled_label = unlabeled_label
         self.debug = debug
 
         # defining sub block sizes (square)
         self.block_dim = block_dim
-        self.min_fill_area = 0.65 * self.block_dim**2
+        self.min_fill_ratio = 0.65
+        self.min_fill_area = self.min_fill_ratio * self.block_dim**2
 
         # setting up logging
         logger = logging.getLogger()
@@ -67,138 +77,252 @@ class TrainingDataGenerator():
 
         ''' Goes through all the annotation files and creates the proper training images in the target folder '''
 
-        # going through the annotation data files in the scr folder
-        for annotation_file in os.listdir(self.src_folder):
-            if annotation_file.endswith(".xml"):
-
-                try : 
-
-                    # loading the current file xml
-                    file_tree = ET.parse(os.path.join(self.src_folder, annotation_file)) 
-                    file_root = file_tree.getroot()
-        
-                    # extracting dimension information
-                    image_width = int(file_root.find('./size/width').text)
-                    image_height = int(file_root.find('./size/height').text)
-                    width_ratio = self.resized_width / image_width 
-                    height_ratio = self.resized_height / image_height
-
-                    # loading and resizing the referenced image
-                    image_file_path = file_root.find('./path').text
-                    image = cv.imread(image_file_path, cv.IMREAD_COLOR)
-                    image = cv.resize(image, (self.resized_width, self.resized_height), 
-                                      interpolation = cv.INTER_AREA)
-
-                    block_index = 0
-
-                    # going through the labelled objects
-                    for labeled_object in file_root.findall('./object'):
-
-                        # extracting the object label
-                        object_label = labeled_object.find('./name').text
-
-                        # extracting object positional information
-                        xmin = int(int(labeled_object.find('./bndbox/xmin').text) * width_ratio)
-                        ymin = int(int(labeled_object.find('./bndbox/ymin').text) * height_ratio)
-                        xmax = int(int(labeled_object.find('./bndbox/xmax').text) * width_ratio)
-                        ymax = int(int(labeled_object.find('./bndbox/ymax').text) * height_ratio)
-
-                        # calculating the object dimensions in terms of blocks
-                        min_row_pos = (ymin // self.block_dim) * self.block_dim
-                        n_vertical_blocks = ((math.ceil(ymax / self.block_dim) * self.block_dim) - min_row_pos) // self.block_dim
-                        min_col_pos = (xmin // self.block_dim) * self.block_dim
-                        n_horizontal_blocks = ((math.ceil(xmax / self.block_dim) * self.block_dim) - min_col_pos) // self.block_dim
-
-                        # going through the block touching the object
-                        current_row = min_row_pos 
-                        current_col = min_col_pos
-                        for _  in range(n_vertical_blocks):
-                            for _ in range(n_horizontal_blocks):
-
-                                fill_width = 0
-                                fill_height = 0
-                                
-                                # calculating the horizontal fill
-                                if xmin > current_col and xmin < (current_col + self.block_dim): 
-                                    fill_width = (current_col + self.block_dim) - xmin
-                                elif xmax > current_col and xmax < (current_col + self.block_dim):
-                                    fill_width = xmax - current_col
-                                else :
-                                    fill_width = self.block_dim
-
-                                # calculating the vertical fill
-                                if ymin > current_row and ymin < (current_row + self.block_dim):
-                                    fill_height = (current_row + self.block_dim) - ymin
-                                elif ymax > current_row and ymax < (current_row + self.block_dim):
-                                    fill_height = ymax - current_row
-                                else :
-                                    fill_height = self.block_dim
-
-                                # only processing blocks which contain enough fill area
-                                if (fill_width * fill_height) > self.min_fill_area:                                
-
-                                    if self.debug :
-                                        
-                                        # adding rectangle overlay on current block (for visualization)
-                                        start_point = (current_col, current_row)
-                                        end_point = (current_col + self.block_dim, current_row + self.block_dim)
-                                        image = cv.rectangle(image, start_point, end_point, (255, 0, 0), 1)                                
-
-                                        # displaying and wainting for user input
-                                        cv.imshow('image', image)  
-                                        cv.waitKey(0)
-
-                                    else:
-
-                                        # creating/saving a sub-image from the current block
-                                        roi = image[current_row : current_row + self.block_dim, current_col : current_col + self.block_dim]
-                                        
-                                        # making sure the subimage is not truncated (happens when sub image is partially out on bounds)
-                                        if roi.shape[0] == self.block_dim and roi.shape[1] == self.block_dim:  
-
-                                            image_file_segs = image_file_path.split("/")[-1].split(".")
-                                            block_file_name = image_file_segs[0] + "_" + str(block_index) + "_" + object_label + "." + image_file_segs[-1]
-                                            block_save_path = os.path.join(self.target_folder, block_file_name)
-                                            cv.imwrite(block_save_path, roi)
-
-                                            block_index += 1
-
-                                # moving to the next horizontal block
-                                current_col += self.block_dim
-
-                            # moving down a row of blocks
-                            current_col = min_col_pos
-                            current_row += self.block_dim
-                        
-                        # destroying debug windows
-                        if self.debug : 
-                            cv.destroyAllWindows()
-
-                except Exception as e:
-                    logging.error("TrainingDataGenerator failed while extracting data from label file : {0}, error : {1}\
-                                  ".format(annotation_file, e))
-                    raise
+        self.generate_multi_size_training_images({self.block_dim : self.target_folder})
+
+
+    def generate_multi_size_training_images(self, target_folders):
+
+        '''
+        Creates the training images of several block sizes from a single decoding / resizing of every source image
+        When more than one worker is defined, the annotation files are distributed to a pool of processes
+
+        Parameters
+        ----------
+        target_folders (dict(int : str)) : folder in which to create the training images, for every block size
+        '''
+
+        block_dims = sorted(target_folders.keys())
+        annotation_files = sorted(element for element in os.listdir(self.src_folder) if element.endswith(".xml"))
+
+        # defining the packed dataset writers
+        dataset_writers = {}
+        for block_dim in block_dims:
+            dataset_writers[block_dim] = PackedDatasetWriter(target_folders[block_dim], block_dim) if self.packed else None
+
+        pool = None
+        try:
+
+            # cutting the training images (in parallel, the results are received in order)
+            if self.n_workers > 1 and not self.debug:
+                pool = multiprocessing.Pool(self.n_workers)
+                annotation_blocks = pool.imap(functools.partial(self.extract_annotation_blocks, block_dims=block_dims), 
+                                              annotation_files)
+            else:
+                annotation_blocks = (self.extract_annotation_blocks(annotation_file, block_dims) 
+                                     for annotation_file in annotation_files)
+
+            # saving the training images of every block size
+            for image_file_name, blocks_per_dim in annotation_blocks:
+                for block_dim in block_dims:
+                    self.save_training_images(image_file_name, blocks_per_dim[block_dim], target_folders[block_dim], 
+                                              dataset_writers[block_dim])
+
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            for dataset_writer in dataset_writers.values():
+                if dataset_writer is not None:
+                    dataset_writer.close()
+
+
+    def extract_annotation_blocks(self, annotation_file, block_dims):
+
+        '''
+        Loads the image referenced by an annotation file and cuts the training images of its labelled objects
+
+        Parameters
+        ----------
+        annotation_file (str) : name of the annotation file (Pascal VOC xml) in the src folder
+        block_dims (list(int)) : sizes (in pixels) of the training images to cut
+
+        Returns
+        -------
+        (str, dict(int : list((numpy.ndarray, str, (int, int))))) : name of the source image file and, 
+            for every block size, the training images with their label and (row, col) position
+        '''
+
+        try : 
+
+            # loading the current file xml
+            file_tree = ET.parse(os.path.join(self.src_folder, annotation_file)) 
+            file_root = file_tree.getroot()
+
+            # extracting dimension information
+            image_width = int(file_root.find('./size/width').text)
+            image_height = int(file_root.find('./size/height').text)
+            width_ratio = self.resized_width / image_width 
+            height_ratio = self.resized_height / image_height
+
+            # loading and resizing the referenced image (once for all the block sizes)
+            image_file_path = file_root.find('./path').text
+            image = cv.imread(image_file_path, cv.IMREAD_COLOR)
+            image = cv.resize(image, (self.resized_width, self.resized_height), 
+                              interpolation = cv.INTER_AREA)
+
+            # extracting the labelled objects
+            labeled_objects = []
+            for labeled_object in file_root.findall('./object'):
+
+                # extracting the object label
+                object_label = labeled_object.find('./name').text
+
+                # extracting object positional information
+                xmin = int(int(labeled_object.find('./bndbox/xmin').text) * width_ratio)
+                ymin = int(int(labeled_object.find('./bndbox/ymin').text) * height_ratio)
+                xmax = int(int(labeled_object.find('./bndbox/xmax').text) * width_ratio)
+                ymax = int(int(labeled_object.find('./bndbox/ymax').text) * height_ratio)
+
+                labeled_objects.append((object_label, xmin, ymin, xmax, ymax))
+
+            blocks_per_dim = {}
+            for block_dim in block_dims:
+                blocks_per_dim[block_dim] = self.cut_object_blocks(image, labeled_objects, block_dim)
+
+            return image_file_path.split("/")[-1], blocks_per_dim
+
+        except Exception as e:
+            logging.error("TrainingDataGenerator failed while extracting data from label file : {0}, error : {1}\
+                          ".format(annotation_file, e))
+            raise
+
+
+    def compute_block_coverage(self, labeled_objects, block_dim):
+
+        '''
+        Computes the area of every block of the grid covered by every labelled object (interval overlaps)
+
+        Parameters
+        ----------
+        labeled_objects (list((str, int, int, int, int))) : label and (xmin, ymin, xmax, ymax) box of every object
+        block_dim (int) : size (in pixels) of the grid blocks (square blocks)
+
+        Returns
+        -------
+        (numpy.ndarray (3D)) : covered area (in pixels) of every block (n_objects, n_blocks_row, n_blocks_col)
+        '''
+
+        n_blocks_row = self.resized_height // block_dim
+        n_blocks_col = self.resized_width // block_dim
+        boxes = np.array([labeled_object[1:] for labeled_object in labeled_objects], dtype=np.int64).reshape(-1, 4)
+
+        # computing the overlap of the object boxes with the block intervals (on every axis)
+        block_rows = np.arange(n_blocks_row) * block_dim
+        block_cols = np.arange(n_blocks_col) * block_dim
+        fill_height = np.minimum(boxes[:, 3, np.newaxis], block_rows + block_dim) - np.maximum(boxes[:, 1, np.newaxis], block_rows)
+        fill_width = np.minimum(boxes[:, 2, np.newaxis], block_cols + block_dim) - np.maximum(boxes[:, 0, np.newaxis], block_cols)
+
+        return np.clip(fill_height, 0, None)[:, :, np.newaxis] * np.clip(fill_width, 0, None)[:, np.newaxis, :]
+
+
+    def cut_object_blocks(self, image, labeled_objects, block_dim):
+
+        '''
+        Cuts the blocks sufficiently filled by the labelled objects
+        Every block is cut once, with the label of the object covering it the most
+
+        Parameters
+        ----------
+        image (numpy.ndarray) : resized source image
+        labeled_objects (list((str, int, int, int, int))) : label and (xmin, ymin, xmax, ymax) box of every object
+        block_dim (int) : size (in pixels) of the training images (square images) 
+
+        Returns
+        -------
+        list((numpy.ndarray, str, (int, int))) : training images with their label and (row, col) position
+        '''
+
+        n_blocks_row = self.resized_height // block_dim
+        n_blocks_col = self.resized_width // block_dim
+        min_fill_area = self.min_fill_ratio * block_dim**2
+
+        # defining the label mask of the block grid (-1 = not sufficiently filled by any object)
+        block_labels = np.full((n_blocks_row, n_blocks_col), -1)
+        if labeled_objects:
+            block_coverage = self.compute_block_coverage(labeled_objects, block_dim)
+            block_labels = np.where(block_coverage.max(axis=0) > min_fill_area, block_coverage.argmax(axis=0), -1)
+
+        label_names = [labeled_object[0] for labeled_object in labeled_objects]
+
+        # blocks covered by no object at all are given the unlabeled label (when defined)
+        if self.unlabeled_label is not None:
+            label_names.append(self.unlabeled_label)
+            if labeled_objects:
+                block_labels[block_coverage.max(axis=0) == 0] = len(label_names) - 1
+            else:
+                block_labels[...] = len(label_names) - 1
+
+        # slicing all the selected blocks at once
+        block_rows, block_cols = np.nonzero(block_labels >= 0)
+        block_grid = image[: n_blocks_row * block_dim, : n_blocks_col * block_dim]
+        block_grid = block_grid.reshape(n_blocks_row, block_dim, n_blocks_col, block_dim, -1).swapaxes(1, 2)
+        rois = block_grid[block_rows, block_cols]
+
+        if self.debug :
+
+            # adding rectangle overlays on the selected blocks (for visualization)
+            for row_i, col_i in zip(block_rows, block_cols):
+                start_point = (int(col_i) * block_dim, int(row_i) * block_dim)
+                end_point = (start_point[0] + block_dim, start_point[1] + block_dim)
+                image = cv.rectangle(image, start_point, end_point, (255, 0, 0), 1)
+
+            # displaying and wainting for user input
+            cv.imshow('image', image)  
+            cv.waitKey(0)
+            cv.destroyAllWindows()
+
+            return []
+
+        return [(roi, label_names[block_labels[row_i, col_i]], (int(row_i) * block_dim, int(col_i) * block_dim)) 
+                for roi, row_i, col_i in zip(rois, block_rows, block_cols)]
+
+
+    def save_training_images(self, image_file_name, object_blocks, target_folder, dataset_writer=None):
+
+        '''
+        Saves the training images cut from a source image
+
+        Parameters
+        ----------
+        image_file_name (str) : name of the source image file
+        object_blocks (list((numpy.ndarray, str, (int, int)))) : training images with their label and position
+        target_folder (str) : folder in which to create the training images
+        dataset_writer (PackedDatasetWriter) : packed dataset receiving the training images (None = image files)
+        '''
+
+        image_file_segs = image_file_name.split(".")
+        for block_index, (roi, object_label, position) in enumerate(object_blocks):
+
+            if dataset_writer is not None:
+                dataset_writer.append(roi, object_label, image_file_name, position)
+            else:
+                block_file_name = image_file_segs[0] + "_" + str(block_index) + "_" + object_label + "." + image_file_segs[-1]
+                cv.imwrite(os.path.join(target_folder, block_file_name), roi)
 
 
 class TrainingDataLoader():
 
     ''' 
     Enables the loading of labeled training data from the an image dataset 
-    The labeled data is the images generated by the "TrainingDataGenerator" 
+    The labeled data is the images generated by the "TrainingDataGenerator" (image files or packed dataset)
     '''
 
     color_spaces = ["RGB", "HSV"]
     image_formats = ["png", "jpg"]
 
 
-    def __init__(self, image_folder, class_def_path, color_space="RGB"):
+    def __init__(self, image_folder, class_def_path, color_space="RGB", cache_folder=None, random_state=None):
 
         '''
         Parameters
         ----------
-        image_folder (str) : path to the folder containing the training images
+        image_folder (str) : path to the folder containing the training images (or a packed dataset)
         class_def_path (str) : path to the class definition file
         color_space (str) : RBG or HSV
+        cache_folder (str) : when defined, the loaded images are cached in this folder 
+                             (keyed on the image file list and modification times)
+        random_state (int) : seed of the training data shuffling (a fixed seed gives the same image order
+                             on every run, which lets the features cached by the extractor be reused)
         '''
 
         if not (color_space in self.color_spaces):
@@ -207,6 +331,8 @@ class TrainingDataLoader():
         self.color_space = color_space
         self.image_folder = image_folder
         self.class_def_path = class_def_path
+        self.cache = FeatureCache(cache_folder) if cache_folder is not None else None
+        self.random_state = random_state
 
         self.class_map = {}
         self.load_classes()
@@ -223,38 +349,377 @@ class TrainingDataLoader():
             self.class_map[class_name.rstrip()] = class_i
 
 
+    def list_image_files(self):
+
+        ''' Returns the sorted names of the training images in the image folder '''
+
+        return sorted(element for element in os.listdir(self.image_folder) 
+                      if element.split(".")[-1] in self.image_formats)
+
+
     def load_training_data(self):
 
         ''' Generates the X (features) and y (label) lists for model training '''
 
+        # reading the images directly from the packed dataset
+        if PackedDataset.is_packed(self.image_folder):
+            feature_container, label_container = self.read_packed_dataset()
+
+        # reading the images from the cache when the image files did not change
+        elif self.cache is not None:
+
+            image_files = self.list_image_files()
+
+            file_stats = [os.stat(os.path.join(self.image_folder, element)) for element in image_files]
+            dataset_key = self.cache.make_key("dataset", os.path.abspath(self.image_folder), self.color_space,
+                                              [(element, stat.st_size, stat.st_mtime_ns) 
+                                               for element, stat in zip(image_files, file_stats)])
+
+            feature_container = self.cache.load(dataset_key + "_images")
+            label_container = self.cache.load(dataset_key + "_labels")
+            if feature_container is None or label_container is None:
+                feature_container, label_container = self.read_images(image_files)
+                feature_container = self.cache.save(dataset_key + "_images", feature_container)
+                label_container = self.cache.save(dataset_key + "_labels", label_container)
+
+        else:
+            feature_container, label_container = self.read_images(self.list_image_files())
+
+        # shuffling the training data
+        shuffled_indices = np.random.RandomState(self.random_state).permutation(label_container.shape[0])
+
+        return feature_container[shuffled_indices], label_container[shuffled_indices]
+
+
+    def read_packed_dataset(self):
+
+        '''
+        Opens the packed dataset of the image folder (the images are memory-mapped, not read)
+
+        Returns
+        -------
+        (numpy.ndarray (4D), numpy.ndarray (1D)) : images and labels, in the packed order
+        '''
+
+        dataset = PackedDataset(self.image_folder)
+
+        if self.color_space == "RGB":
+            return dataset.images, self.packed_class_labels(dataset)
+        else:
+            return PackedDataset.convert_color(dataset.images, cv.COLOR_BGR2HSV), self.packed_class_labels(dataset)
+
+
+    def packed_class_labels(self, dataset):
+
+        ''' Converts the label names of a packed dataset to class indices '''
+
+        label_names, label_indices = np.unique(dataset.labels, return_inverse=True)
+        return np.array([self.class_map[label_name] for label_name in label_names], dtype=int)[label_indices]
+
+
+    def iter_training_batches(self, batch_size=256, buffer_size=8192, random_state=None):
+
+        '''
+        Yields shuffled mini-batches of training data with bounded memory usage
+        The images are read "buffer_size" at a time (random subset of the dataset), then shuffled into mini-batches
+
+        Parameters
+        ----------
+        batch_size (int) : number of images in every mini-batch
+        buffer_size (int) : maximum number of images held in memory at once
+        random_state (int) : seed of the shuffling (defaults to the loader seed)
+
+        Yields
+        ------
+        (numpy.ndarray (4D), numpy.ndarray (1D)) : images and labels of a mini-batch
+        '''
+
+        random_state = np.random.RandomState(self.random_state if random_state is None else random_state)
+
+        # defining how the images of a buffer are read (by index)
+        if PackedDataset.is_packed(self.image_folder):
+            dataset = PackedDataset(self.image_folder)
+            label_container = self.packed_class_labels(dataset)
+            n_images = len(dataset)
+            def read_buffer(indices):
+                images = np.asarray(dataset.images[indices])
+                if self.color_space == "HSV":
+                    images = PackedDataset.convert_color(images, cv.COLOR_BGR2HSV)
+                return images, label_container[indices]
+        else:
+            image_files = np.array(self.list_image_files())
+            n_images = len(image_files)
+            def read_buffer(indices):
+                return self.read_images(image_files[indices])
+
+        shuffled_indices = random_state.permutation(n_images)
+
+        for buffer_start in range(0, n_images, buffer_size):
+
+            # reading the buffer images in storage order (sequential access)
+            feature_buffer, label_buffer = read_buffer(np.sort(shuffled_indices[buffer_start : buffer_start + buffer_size]))
+
+            # shuffling the buffer into mini-batches
+            buffer_order = random_state.permutation(label_buffer.shape[0])
+            for batch_start in range(0, buffer_order.shape[0], batch_size):
+                batch_indices = buffer_order[batch_start : batch_start + batch_size]
+                yield feature_buffer[batch_indices], label_buffer[batch_indices]
+
+
+    def read_images(self, image_files):
+
+        '''
+        Reads the training images and their labels
+
+        Parameters
+        ----------
+        image_files (list(str)) : names of the image files in the image folder
+
+        Returns
+        -------
+        (numpy.ndarray (4D), numpy.ndarray (1D)) : images and labels, in the image file order
+        '''
+
         feature_container = []
         label_container = []
 
         # going through the training images
-        for element in os.listdir(self.image_folder):
-            if element.split(".")[-1] in self.image_formats:
-
-                # loading the current image
-                image_path = os.path.join(self.image_folder, element)
-                if self.color_space == "RGB":
-                    image_mat = cv.imread(image_path, cv.IMREAD_COLOR)
-                else:
-                    image_mat = cv.imread(image_path, cv.COLOR_RGB2HSV)
-
-                # loading the current label
-                image_label = self.class_map[(image_path.split("_")[-1].split(".")[0])]
-                
-                feature_container.append(image_mat)
-                label_container.append(image_label)
-                
-        # shuffling the training data
-        zipped_data = list(zip(feature_container, label_container))
-        random.shuffle(zipped_data)
-        feature_container, label_container = zip(*zipped_data)
+        for element in image_files:
+
+            # loading the current image
+            image_path = os.path.join(self.image_folder, element)
+            if self.color_space == "RGB":
+                image_mat = cv.imread(image_path, cv.IMREAD_COLOR)
+            else:
+                image_mat = cv.imread(image_path, cv.COLOR_RGB2HSV)
+
+            # loading the current label
+            image_label = self.class_map[(image_path.split("_")[-1].split(".")[0])]
+            
+            feature_container.append(image_mat)
+            label_container.append(image_label)
 
         # converting the containers to numpy arrays
-        label_container = np.array(list(label_container))
-        feature_container = list(feature_container)
-        feature_container = np.concatenate([mat[np.newaxis] for mat in feature_container])
+        label_container = np.array(label_container)
+        feature_container = np.stack(feature_container)
+
+        return feature_container, label_container
+
+
+class FeatureCache():
+
+    ''' 
+    On-disk cache of arrays (one .npy file per entry, memory-mapped when loaded)
+    Entries are keyed on a hash of everything they depend on (file lists, image content, extractor parameters)
+    '''
+
+    def __init__(self, cache_folder):
+
+        '''
+        Parameters
+        ----------
+        cache_folder (str) : folder in which to store the cached arrays
+        '''
+
+        self.cache_folder = cache_folder
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+
+    def make_key(self, *key_parts):
+
+        '''
+        Hashes the provided parts (numpy arrays are hashed on their content) into a cache key
+
+        Returns
+        -------
+        (str) : cache key
+        '''
+
+        hasher = hashlib.sha1()
+        for key_part in key_parts:
+            if isinstance(key_part, np.ndarray):
+                hasher.update(repr((key_part.shape, key_part.dtype.str)).encode())
+                hasher.update(np.ascontiguousarray(key_part).data)
+            else:
+                hasher.update(repr(key_part).encode())
+
+        return hasher.hexdigest()
+
+
+    def entry_path(self, key):
+
+        ''' Returns the path of the .npy file of a cache entry '''
+
+        return os.path.join(self.cache_folder, key + ".npy")
+
+
+    def load(self, key):
+
+        '''
+        Returns
+        -------
+        (numpy.memmap / None) : cached array (read-only memory map), None when not cached
+        '''
+
+        entry_path = self.entry_path(key)
+        if not os.path.isfile(entry_path):
+            return None
+
+        return np.load(entry_path, mmap_mode="r")
+
+
+    def save(self, key, array):
+
+        '''
+        Stores an array in the cache (atomically, concurrent writers of the same entry are safe)
+
+        Returns
+        -------
+        (numpy.memmap) : cached array (read-only memory map)
+        '''
+
+        entry_path = self.entry_path(key)
+        temp_path = "{0}.{1}.tmp.npy".format(entry_path[: -len(".npy")], os.getpid())
+
+        np.save(temp_path, array)
+        os.replace(temp_path, entry_path)
+
+        return self.load(key)
+
+
+class PackedDataset():
+
+    ''' 
+    Training images packed in a single contiguous uint8 array, with label and provenance arrays
+    All the arrays are memory-mapped when the dataset is opened (lazy access)
+
+    Dataset folder content : 
+        - meta.json : number of images and image shape
+        - images.bin : raw uint8 image array (n_images, block_dim, block_dim, n_channels)
+        - labels.npy : label name of every image
+        - sources.npy : name of the source image of every image
+        - positions.npy : (row, col) position of every image in the resized source image
+    '''
+
+    meta_file = "meta.json"
+    images_file = "images.bin"
+    labels_file = "labels.npy"
+    sources_file = "sources.npy"
+    positions_file = "positions.npy"
+
+
+    def __init__(self, dataset_folder):
+
+        '''
+        Parameters
+        ----------
+        dataset_folder (str) : folder containing the packed dataset files
+        '''
+
+        self.dataset_folder = dataset_folder
+
+        with open(os.path.join(dataset_folder, self.meta_file), "r") as meta_file_h:
+            self.meta = json.load(meta_file_h)
+
+        # memory-mapping the dataset arrays
+        image_shape = (self.meta["n_images"],) + tuple(self.meta["image_shape"])
+        if self.meta["n_images"] > 0:
+            self.images = np.memmap(os.path.join(dataset_folder, self.images_file), dtype=np.uint8, 
+                                    mode="r", shape=image_shape)
+        else:
+            self.images = np.empty(image_shape, dtype=np.uint8)
+        self.labels = np.load(os.path.join(dataset_folder, self.labels_file), mmap_mode="r")
+        self.sources = np.load(os.path.join(dataset_folder, self.sources_file), mmap_mode="r")
+        self.positions = np.load(os.path.join(dataset_folder, self.positions_file), mmap_mode="r")
+
+
+    def __len__(self):
+        return self.meta["n_images"]
+
+
+    @classmethod
+    def is_packed(cls, dataset_folder):
+
+        ''' Checks if the folder contains a (complete) packed dataset '''
+
+        return os.path.isfile(os.path.join(dataset_folder, cls.meta_file))
+
+
+    @classmethod
+    def convert_color(cls, images, conversion_code):
+
+        ''' Applies an OpenCV color conversion to a batch of images with a single call '''
+
+        n_images, height, width, n_channels = images.shape
+        converted = cv.cvtColor(np.ascontiguousarray(images).reshape(n_images * height, width, n_channels), 
+                                conversion_code)
+        return converted.reshape(n_images, height, width, -1)
+
+
+class PackedDatasetWriter():
+
+    ''' Writes training images directly to a packed dataset (see "PackedDataset") '''
+
+    def __init__(self, dataset_folder, block_dim, n_channels=3):
+
+        '''
+        Parameters
+        ----------
+        dataset_folder (str) : folder in which to create the packed dataset files
+        block_dim (int) : size (in pixels) of the training images (square images) 
+        n_channels (int) : number of color channels of the training images
+        '''
+
+        self.dataset_folder = dataset_folder
+        self.image_shape = (block_dim, block_dim, n_channels)
+
+        self.labels = []
+        self.sources = []
+        self.positions = []
+
+        # removing the meta file of a previous dataset (the folder is incomplete until "close")
+        os.makedirs(dataset_folder, exist_ok=True)
+        meta_path = os.path.join(dataset_folder, PackedDataset.meta_file)
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+
+        # the image file is appended to as the images are generated
+        self.images_file_h = open(os.path.join(dataset_folder, PackedDataset.images_file), "wb")
+
+
+    def append(self, image, label, source, position):
+
+        '''
+        Parameters
+        ----------
+        image (numpy.ndarray) : training image (block_dim, block_dim, n_channels)
+        label (str) : label name of the training image
+        source (str) : name of the source image
+        position (int, int) : (row, col) position of the training image in the resized source image
+        '''
+
+        if image.shape != self.image_shape:
+            raise ValueError("Invalid training image shape")
+
+        self.images_file_h.write(np.ascontiguousarray(image, dtype=np.uint8).tobytes())
+        self.labels.append(label)
+        self.sources.append(source)
+        self.positions.append(position)
+
+
+    def close(self):
+
+        ''' Writes the label and provenance arrays, the meta file is written last (marks a complete dataset) '''
+
+        self.images_file_h.close()
+
+        np.save(os.path.join(self.dataset_folder, PackedDataset.labels_file), np.array(self.labels, dtype=str))
+        np.save(os.path.join(self.dataset_folder, PackedDataset.sources_file), np.array(self.sources, dtype=str))
+        np.save(os.path.join(self.dataset_folder, PackedDataset.positions_file), 
+                np.array(self.positions, dtype=np.int32).reshape(-1, 2))
 
-        return feature_container, label_container
\ No newline at end of file
+        # the meta file is written to a temporary file and moved in place (only appears once complete)
+        meta_path = os.path.join(self.dataset_folder, PackedDataset.meta_file)
+        with open(meta_path + ".tmp", "w") as meta_file_h:
+            json.dump({"n_images" : len(self.labels), "image_shape" : list(self.image_shape)}, meta_file_h)
+        os.replace(meta_path + ".tmp", meta_path)
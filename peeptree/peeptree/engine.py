@@ -0,0 +1,255 @@
+import os
+import json
+import numpy as np
+
+from .features import FeatureComputer
+
+
+class CompiledClassifier():
+
+    '''
+    Pickle free inference engine, running a trained classification pipeline with NumPy only
+    The pipeline parameters are exported to a ".npz" file (see "export"), loading it requires
+    neither scikit-learn nor scikit-image (fast startup and no version coupling on the drone side)
+
+    Supported pipelines : feature extractor -> [normalizer] -> [Nystroem kernel map] -> SVC / linear model
+    '''
+
+    file_extension = ".npz"
+    kernels = ["linear", "poly", "rbf", "sigmoid"]
+    normalizer_norms = ["l1", "l2", "max"]
+
+    # kernel parameter defaults of the scikit-learn kernel maps
+    kernel_map_defaults = {"degree" : 3, "coef0" : 1}
+
+    # exported classifiers are checked against their pipeline on random images (decision value tolerance)
+    n_check_images = 64
+    check_image_size = 20
+    check_tolerance = 1e-5
+
+    # when defined, the inference steps are timed (LatencyRecorder)
+    latency_recorder = None
+
+
+    def __init__(self, compiled_path):
+
+        '''
+        Parameters
+        ----------
+        compiled_path (str) : path to the compiled classifier (.npz file)
+        '''
+
+        with np.load(compiled_path, allow_pickle=False) as compiled_data:
+            arrays = {name : compiled_data[name] for name in compiled_data.files}
+
+        self.config = json.loads(str(arrays.pop("config")))
+        self.arrays = arrays
+        self.classes = arrays["classes"]
+        self.feature_extractor = FeatureComputer(**self.config["extractor_params"])
+
+
+    @classmethod
+    def export(cls, clf_pipeline, compiled_path, X_check=None):
+
+        '''
+        Exports the parameters of a trained classification pipeline
+        The compiled classifier is checked against the pipeline, it is not exported when they disagree
+
+        Parameters
+        ----------
+        clf_pipeline (sklearn.pipeline.Pipeline) : trained classification pipeline (binary classification)
+        compiled_path (str) : path of the output compiled classifier (.npz file)
+        X_check (numpy.ndarray (4D)) : images scored by both classifiers (random images when None)
+        '''
+
+        if not hasattr(clf_pipeline, "steps"):
+            raise ValueError("Only classification pipelines can be compiled")
+
+        steps = [step for _, step in clf_pipeline.steps]
+        extractor, model = steps[0], steps[-1]
+        config = {"normalizer_norm" : None, "kernel_map" : None}
+
+        # extractor parameters (the cache only matters during training)
+        config["extractor_params"] = {name : value for name, value in extractor.get_params().items()
+                                      if name != "cache_folder"}
+
+        # intermediate steps (normalization and kernel approximation)
+        arrays = {}
+        for step in steps[1 : -1]:
+
+            if hasattr(step, "norm"):
+                if step.norm not in cls.normalizer_norms:
+                    raise ValueError("Unsupported normalizer norm")
+                config["normalizer_norm"] = step.norm
+
+            elif hasattr(step, "components_") and hasattr(step, "normalization_"):
+                kernel_params = {"kernel" : step.kernel, "degree" : step.degree, "coef0" : step.coef0,
+                                 "gamma" : step.gamma}
+                for name, value in cls.kernel_map_defaults.items():
+                    if kernel_params[name] is None: kernel_params[name] = value
+                if kernel_params["gamma"] is None:
+                    kernel_params["gamma"] = 1.0 / step.components_.shape[1]
+                config["kernel_map"] = kernel_params
+                arrays["kernel_map_components"] = step.components_
+                arrays["kernel_map_normalization"] = step.normalization_
+
+            else:
+                raise ValueError("Unsupported pipeline step : " + type(step).__name__)
+
+        if len(model.classes_) != 2:
+            raise ValueError("Only binary classifiers can be compiled")
+
+        # kernel SVM (support vectors and dual coefficients) or linear model (weights)
+        if hasattr(model, "support_vectors_"):
+            config["model"] = {"type" : "kernel_svm", "kernel" : model.kernel, "degree" : int(model.degree),
+                               "coef0" : float(model.coef0), "gamma" : float(model._gamma)}
+            arrays["support_vectors"] = model.support_vectors_
+            arrays["dual_coef"] = model.dual_coef_[0]
+        elif hasattr(model, "coef_"):
+            config["model"] = {"type" : "linear"}
+            arrays["coef"] = model.coef_[0]
+        else:
+            raise ValueError("Unsupported classification model : " + type(model).__name__)
+
+        for kernel_params in (config["kernel_map"], config["model"]):
+            if kernel_params is not None and kernel_params.get("kernel", "linear") not in cls.kernels:
+                raise ValueError("Unsupported kernel")
+
+        arrays["intercept"] = np.asarray(model.intercept_, dtype=np.float64).reshape(-1)[: 1]
+        arrays["classes"] = np.asarray(model.classes_)
+        np.savez(compiled_path, config=np.array(json.dumps(config)), **arrays)
+
+        # comparing the decision values of both classifiers (on the same features, the cache is not used)
+        if X_check is None:
+            X_check = np.random.default_rng(0).integers(0, 256, (cls.n_check_images, cls.check_image_size, 
+                                                                 cls.check_image_size, 3), dtype=np.uint8)
+        compiled_clf = cls(compiled_path)
+        features = compiled_clf.feature_extractor.extract_features(np.asarray(X_check))
+        pipeline_values = clf_pipeline[1:].decision_function(features)
+        compiled_values = compiled_clf.decision_features(features)
+
+        if not np.allclose(compiled_values, pipeline_values, rtol=cls.check_tolerance, atol=cls.check_tolerance):
+            os.remove(compiled_path)
+            raise ValueError("The compiled classifier disagrees with the pipeline (max decision value difference : "
+                             "{0:.3g})".format(np.abs(compiled_values - pipeline_values).max()))
+
+
+    def predict(self, X):
+
+        '''
+        Returns
+        -------
+        int : predicted class of the first input image
+        '''
+
+        return self.classes[int(self.decision_batch(X)[0] > 0)]
+
+
+    def decision_batch(self, X):
+
+        '''
+        Scores a batch of images (signed distance to the decision boundary, positive = second class)
+
+        Parameters
+        ----------
+        X (numpy.ndarray (4D)) : array of images (n_images, height, width, n_channels)
+
+        Returns
+        -------
+        (numpy.ndarray (1D)) : score of every input image
+        '''
+
+        features = self.feature_extractor.extract_features(np.asarray(X))
+        self.record_stage("features")
+
+        return self.decision_features(features)
+
+
+    def decision_features(self, features):
+
+        '''
+        Computes the signed distances to the decision boundary (positive values = second class)
+
+        Parameters
+        ----------
+        features (numpy.ndarray (2D)) : feature vectors produced by the feature extractor
+
+        Returns
+        -------
+        (numpy.ndarray (1D)) : decision value of every feature vector
+        '''
+
+        # the intermediate steps run in the precision of the features (float32, as in the pipeline), 
+        # the decision function in float64
+        X = np.asarray(features)
+        if not np.issubdtype(X.dtype, np.floating):
+            X = X.astype(np.float64)
+
+        # normalizing the feature vectors (null vectors are left unchanged)
+        norm = self.config["normalizer_norm"]
+        if norm is not None:
+            if norm == "l1":
+                norms = np.abs(X).sum(axis=1)
+            elif norm == "l2":
+                norms = np.sqrt(np.einsum("ij,ij->i", X, X))
+            else:
+                norms = np.abs(X).max(axis=1)
+            norms[norms == 0] = 1
+            X = X / norms[:, np.newaxis]
+        self.record_stage("normalization")
+
+        # mapping the feature vectors to the approximated kernel space
+        if self.config["kernel_map"] is not None:
+            X = self.compute_kernel(X, self.arrays["kernel_map_components"], self.config["kernel_map"])
+            X = X @ self.arrays["kernel_map_normalization"].T
+
+        # evaluating the decision function
+        X = X.astype(np.float64)
+        model = self.config["model"]
+        if model["type"] == "kernel_svm":
+            decision_values = self.compute_kernel(X, self.arrays["support_vectors"], model) @ self.arrays["dual_coef"]
+        else:
+            decision_values = X @ self.arrays["coef"]
+
+        decision_values = decision_values + self.arrays["intercept"][0]
+        self.record_stage("prediction")
+
+        return decision_values
+
+
+    def record_stage(self, stage):
+
+        ''' Records the time elapsed since the last recorded stage (when a latency recorder is defined) '''
+
+        if self.latency_recorder is not None:
+            self.latency_recorder.lap(stage)
+
+
+    def compute_kernel(self, X, Y, kernel_params):
+
+        '''
+        Computes the kernel matrix between two sets of vectors (same definitions as scikit-learn)
+
+        Returns
+        -------
+        (numpy.ndarray (2D)) : kernel values (len(X), len(Y))
+        '''
+
+        kernel = kernel_params["kernel"]
+        if kernel == "linear":
+            return X @ Y.T
+
+        # the squared distances are computed in float64 and cast back (as scikit-learn does for float32 inputs)
+        if kernel == "rbf":
+            X_64, Y_64 = X.astype(np.float64), Y.astype(np.float64)
+            sq_distances = -2 * (X_64 @ Y_64.T)
+            sq_distances += np.einsum("ij,ij->i", X_64, X_64)[:, np.newaxis]
+            sq_distances += np.einsum("ij,ij->i", Y_64, Y_64)[np.newaxis, :]
+            sq_distances = np.maximum(sq_distances.astype(X.dtype), 0)
+            return np.exp(-kernel_params["gamma"] * sq_distances)
+
+        dot_products = kernel_params["gamma"] * (X @ Y.T) + kernel_params["coef0"]
+        if kernel == "poly":
+            return dot_products ** kernel_params["degree"]
+
+        return np.tanh(dot_products)
@@ -0,0 +1,501 @@
+import cv2 as cv
+import numpy as np
+
+
+class FeatureComputer():
+
+    ''' 
+    Computes the features of image batches with NumPy only (no scikit-learn or scikit-image dependency)
+    Shared by the scikit-learn feature extractor and the compiled inference engine
+    
+    Features : 
+        - Color histogram bins
+        - Color channel stats
+        - LPB descriptor
+    '''
+    
+    eps=1e-7
+    color_max_value = 255
+    color_spaces = ["RGB", "HSV"]
+    channel_hist_ranges = ["block", "full"]
+
+    # defaults for extractors pickled before the parameters existed
+    channel_hist_range = "block"
+    
+    def __init__(self, color_space="RGB", channel_hist_n_bins=15, lbp_n_points=8, 
+                 lbp_radius=1, fusion_method=1, channel_hist_range="block"):
+        
+        '''
+        Parameters
+        ----------
+        lbp_radius (int) : neighbor radius used when calculating the lbp descriptor
+        lbp_n_points (int) : number of neighbour considered when calculating the LBP values
+        fusion_method (int) : 1 or 2, fusion methods a described in the reference paper
+        color_space (str) : input image color space (HSV, RBG)
+        channel_hist_range (str) : "block" = histogram bins span the value range of each image channel
+                                   "full" = histogram bins span [0, color_max_value] (required by integral histograms)
+        '''
+
+        if not (color_space in self.color_spaces):
+            raise ValueError("Invalid color space")
+
+        if not (fusion_method == 1 or fusion_method == 2):
+            raise ValueError("Invalid fusion method") 
+
+        if not (channel_hist_range in self.channel_hist_ranges):
+            raise ValueError("Invalid channel histogram range")
+
+        self.lbp_radius = lbp_radius
+        self.color_space = color_space
+        self.lbp_n_points = lbp_n_points
+        self.fusion_method = fusion_method 
+        self.channel_hist_n_bins = channel_hist_n_bins
+        self.channel_hist_range = channel_hist_range
+
+
+    @property
+    def n_features(self):
+
+        ''' Length of the feature vectors produced by the extractor '''
+
+        n_lbp_channels = 1 if self.fusion_method == 1 else 3
+        return self.n_color_features + n_lbp_channels * (self.lbp_n_points + 2)
+
+
+    @property
+    def n_color_features(self):
+
+        ''' Length of the color part (channel histograms and stats) at the start of the feature vectors '''
+
+        return 3 * (self.channel_hist_n_bins + 2)
+
+
+    def extract_features(self, X):
+
+        '''
+        Parameters
+        ------
+        X (numpy.ndarray (4D)) : array of images in 3D color space (RBG or HSV)
+        
+        Returns
+        -------
+        (np.ndarray (2D)) : list of feature vectors
+        '''
+
+        lbp_histograms = self.compute_batch_lbp_histograms(self.compute_batch_lbp_codes(self.lbp_images(X)))
+
+        return self.build_feature_matrix(self.compute_batch_channel_histograms(X), 
+                                         self.compute_batch_channel_stats(X), lbp_histograms)
+
+
+    def extract_color_features(self, X):
+
+        '''
+        Extracts the color part of the feature vectors only (no LBP codes are computed)
+
+        Parameters
+        ------
+        X (numpy.ndarray (4D)) : array of images in 3D color space (RBG or HSV)
+        
+        Returns
+        -------
+        (np.ndarray (2D)) : color feature vectors (n_images, n_color_features)
+        '''
+
+        n_hist_bins = self.channel_hist_n_bins
+        color_features = np.empty((X.shape[0], 3, n_hist_bins + 2), dtype=np.float32)
+        color_features[..., : n_hist_bins] = self.compute_batch_channel_histograms(X)
+        color_features[..., n_hist_bins :] = self.compute_batch_channel_stats(X)
+
+        return color_features.reshape(X.shape[0], -1)
+
+
+    def complete_color_features(self, color_features, X):
+
+        '''
+        Completes color feature vectors with the LBP features of their images
+
+        Parameters
+        ------
+        color_features (np.ndarray (2D)) : color feature vectors (see "extract_color_features")
+        X (numpy.ndarray (4D)) : array of the corresponding images in 3D color space (RBG or HSV)
+        
+        Returns
+        -------
+        (np.ndarray (2D)) : list of feature vectors
+        '''
+
+        lbp_histograms = self.compute_batch_lbp_histograms(self.compute_batch_lbp_codes(self.lbp_images(X)))
+
+        feature_container = np.empty((X.shape[0], self.n_features), dtype=np.float32)
+        feature_container[:, : self.n_color_features] = color_features
+        feature_container[:, self.n_color_features :] = lbp_histograms.reshape(X.shape[0], -1)
+
+        return feature_container
+
+
+    def transform_frame(self, image, block_size):
+
+        '''
+        Extracts the feature vectors of every block of an image
+        The LBP codes are computed once for the whole image (blocks get their true border neighbors)
+
+        Parameters
+        ----------
+        image (numpy.ndarray) : image in 3D color space (RBG or HSV)
+        block_size (int) : size (in pixels) of the square blocks
+
+        Returns
+        -------
+        (np.ndarray (2D)) : feature vectors (n_blocks, n_features), blocks in row major order
+        '''
+
+        n_blocks_row = image.shape[0] // block_size
+        n_blocks_col = image.shape[1] // block_size
+        grid_height = n_blocks_row * block_size
+        grid_width = n_blocks_col * block_size
+
+        # tiling the image into its grid of blocks
+        blocks = image[: grid_height, : grid_width].reshape(n_blocks_row, block_size, n_blocks_col, block_size, -1)
+        blocks = blocks.swapaxes(1, 2).reshape(n_blocks_row * n_blocks_col, block_size, block_size, -1)
+
+        # computing the LBP codes of the whole image and reducing them block by block
+        lbp_codes = self.compute_batch_lbp_codes(self.lbp_images(image[np.newaxis]))[0]
+        lbp_codes = lbp_codes[:, : grid_height, : grid_width].reshape(-1, n_blocks_row, block_size, 
+                                                                       n_blocks_col, block_size)
+        lbp_histograms = self.compute_batch_lbp_histograms(lbp_codes.transpose(1, 3, 0, 2, 4))
+        lbp_histograms = lbp_histograms.reshape(blocks.shape[0], -1, self.lbp_n_points + 2)
+
+        return self.build_feature_matrix(self.compute_batch_channel_histograms(blocks), 
+                                         self.compute_batch_channel_stats(blocks), lbp_histograms)
+
+
+    def build_feature_matrix(self, channel_histograms, channel_stats, lbp_histograms):
+
+        '''
+        Assembles the feature vectors of a batch of images
+
+        Parameters
+        ----------
+        channel_histograms (numpy.ndarray (3D)) : channel histograms (n_images, n_channels, channel_hist_n_bins)
+        channel_stats (numpy.ndarray (3D)) : channel stats (n_images, n_channels, 2)
+        lbp_histograms (numpy.ndarray (3D)) : LBP histograms (n_images, n_lbp_channels, lbp_n_points + 2)
+
+        Returns
+        -------
+        (np.ndarray (2D)) : list of feature vectors
+        '''
+
+        n_images = channel_histograms.shape[0]
+        n_hist_bins = self.channel_hist_n_bins
+
+        # defining the output container
+        feature_container = np.empty((n_images, self.n_features), dtype=np.float32)
+
+        # adding the color channel features (histogram followed by stats, for every channel)
+        channel_features = feature_container[:, : self.n_color_features].reshape(n_images, 3, n_hist_bins + 2)
+        channel_features[..., : n_hist_bins] = channel_histograms
+        channel_features[..., n_hist_bins :] = channel_stats
+
+        # adding the LBP features (gray scale image or all color channels)
+        feature_container[:, self.n_color_features :] = lbp_histograms.reshape(n_images, -1)
+
+        return feature_container
+
+
+    def lbp_images(self, X):
+
+        '''
+        Isolates the single channel images on which the LBP descriptors are computed
+
+        Parameters
+        ----------
+        X (numpy.ndarray (4D)) : array of images in 3D color space (RBG or HSV)
+
+        Returns
+        -------
+        (numpy.ndarray (4D)) : single channel images (n_images, n_lbp_channels, height, width)
+        '''
+
+        # LBP features from the gray scale image (or the value channel in HSV)
+        if self.fusion_method == 1:
+
+            if self.color_space == "RGB":
+                n_images, height, width, _ = X.shape
+                gray = cv.cvtColor(np.ascontiguousarray(X).reshape(n_images * height, width, 3), cv.COLOR_BGR2GRAY)
+                return gray.reshape(n_images, 1, height, width)
+            else:
+                return X[:, np.newaxis, :, :, 2]
+
+        # LBP features from all color channels
+        return np.moveaxis(X, -1, 1)
+
+
+    def compute_batch_lbp_codes(self, images):
+
+        '''
+        Computes the uniform LBP code of every pixel (same codes as skimage's "uniform" method)
+
+        Parameters
+        ----------
+        images (numpy.ndarray) : single channel images, the last two axes being (height, width)
+
+        Returns
+        -------
+        (numpy.ndarray) : LBP codes (0 to lbp_n_points + 1), same shape as the input
+        '''
+
+        images = np.asarray(images, dtype=np.float64)
+        height, width = images.shape[-2:]
+
+        # zero padding the images (pixels outside of the images are considered as 0)
+        pad = int(np.ceil(self.lbp_radius)) + 1
+        pad_width = [(0, 0)] * (images.ndim - 2) + [(pad, pad), (pad, pad)]
+        padded = np.pad(images, pad_width, mode="constant")
+
+        # defining the circular neighborhood offsets
+        angles = 2 * np.pi * np.arange(self.lbp_n_points) / self.lbp_n_points
+        row_offsets = np.round(-self.lbp_radius * np.sin(angles), 5)
+        col_offsets = np.round(self.lbp_radius * np.cos(angles), 5)
+
+        rows = np.arange(height, dtype=np.float64)[:, np.newaxis]
+        cols = np.arange(width, dtype=np.float64)[np.newaxis, :]
+
+        n_ones = np.zeros(images.shape, dtype=np.int32)
+        n_changes = np.zeros(images.shape, dtype=np.int32)
+        previous_bits = None
+
+        for row_offset, col_offset in zip(row_offsets, col_offsets):
+
+            # bilinear interpolation of the neighbor values
+            min_row, max_row = int(np.floor(row_offset)), int(np.ceil(row_offset))
+            min_col, max_col = int(np.floor(col_offset)), int(np.ceil(col_offset))
+            d_row = (rows + row_offset) - (rows + min_row)
+            d_col = (cols + col_offset) - (cols + min_col)
+
+            top_left = padded[..., pad + min_row : pad + min_row + height, pad + min_col : pad + min_col + width]
+            top_right = padded[..., pad + min_row : pad + min_row + height, pad + max_col : pad + max_col + width]
+            bottom_left = padded[..., pad + max_row : pad + max_row + height, pad + min_col : pad + min_col + width]
+            bottom_right = padded[..., pad + max_row : pad + max_row + height, pad + max_col : pad + max_col + width]
+
+            top = (1 - d_col) * top_left + d_col * top_right
+            bottom = (1 - d_col) * bottom_left + d_col * bottom_right
+            neighbor = (1 - d_row) * top + d_row * bottom
+
+            # thresholding against the center pixel and counting the bit transitions
+            bits = (neighbor - images) >= 0
+            n_ones += bits
+            if previous_bits is not None:
+                n_changes += bits != previous_bits
+            previous_bits = bits
+
+        # non uniform patterns are all mapped to the same code
+        return np.where(n_changes <= 2, n_ones, self.lbp_n_points + 1)
+
+
+    def compute_batch_lbp_histograms(self, lbp_codes):
+
+        '''
+        Computes the normalized LBP histograms of a batch of LBP code images
+
+        Parameters
+        ----------
+        lbp_codes (numpy.ndarray) : LBP codes, the last two axes being (height, width)
+
+        Returns
+        -------
+        (numpy.ndarray) : LBP histograms, the last axis being the histogram bins
+        '''
+
+        n_bins = self.lbp_n_points + 2
+        codes = lbp_codes.reshape(-1, lbp_codes.shape[-2] * lbp_codes.shape[-1])
+
+        # counting the codes of every image with a single bincount (offset bin indices)
+        offsets = (np.arange(codes.shape[0]) * n_bins)[:, np.newaxis]
+        hist = np.bincount((codes + offsets).ravel(), minlength=codes.shape[0] * n_bins)
+        hist = hist.reshape(lbp_codes.shape[:-2] + (n_bins,)).astype("float")
+
+        # normalizing the histograms
+        hist /= (hist.sum(axis=-1, keepdims=True) + self.eps)
+
+        return hist
+
+
+    def compute_batch_channel_histograms(self, X):
+
+        '''
+        Computes the normalized value histograms of every channel of a batch of images
+        (same bins as "numpy.histogram" with "channel_hist_n_bins" bins over the block value range or the full range)
+
+        Parameters
+        ----------
+        X (numpy.ndarray (4D)) : array of images in 3D color space (RBG or HSV)
+
+        Returns
+        -------
+        (numpy.ndarray (3D)) : channel histograms (n_images, n_channels, channel_hist_n_bins)
+        '''
+
+        n_bins = self.channel_hist_n_bins
+        values = np.moveaxis(X.reshape(X.shape[0], -1, X.shape[-1]), -1, 1).astype(np.float64, order="C")
+
+        # defining the bin edges from the value range of every channel
+        if self.channel_hist_range == "full":
+            first_edges = np.zeros(values.shape[:-1])
+            last_edges = np.full(values.shape[:-1], float(self.color_max_value))
+        else:
+            first_edges = values.min(axis=-1)
+            last_edges = values.max(axis=-1)
+            flat_channels = first_edges == last_edges
+            first_edges[flat_channels] -= 0.5
+            last_edges[flat_channels] += 0.5
+
+        indices = self.compute_bin_indices(values, first_edges, last_edges)
+
+        # counting the values of every channel with a single bincount (offset bin indices)
+        n_histograms = values.shape[0] * values.shape[1]
+        offsets = (np.arange(n_histograms) * n_bins).reshape(values.shape[0], values.shape[1], 1)
+        hist = np.bincount((indices + offsets).ravel(), minlength=n_histograms * n_bins)
+        hist = hist.reshape(values.shape[0], values.shape[1], n_bins).astype("float")
+
+        # normalizing the histograms
+        hist /= (hist.sum(axis=-1, keepdims=True) + self.eps)
+
+        return hist
+
+
+    def compute_bin_indices(self, values, first_edges, last_edges):
+
+        '''
+        Computes histogram bin indices as "np.histogram" does with uniform bins
+
+        Parameters
+        ----------
+        values (numpy.ndarray) : values to bin (float64), the last axis being the binned values
+        first_edges (numpy.ndarray) : first bin edge for every set of values (values.shape[:-1])
+        last_edges (numpy.ndarray) : last bin edge for every set of values (values.shape[:-1])
+
+        Returns
+        -------
+        (numpy.ndarray) : bin index of every value (0 to channel_hist_n_bins - 1)
+        '''
+
+        n_bins = self.channel_hist_n_bins
+        bin_edges = np.linspace(first_edges, last_edges, n_bins + 1, axis=-1)
+
+        # computing the bin indices (the last bin includes the right edge)
+        indices = ((values - first_edges[..., np.newaxis]) 
+                   / (last_edges - first_edges)[..., np.newaxis] * n_bins).astype(np.intp)
+        indices[indices == n_bins] -= 1
+        indices[values < np.take_along_axis(bin_edges, indices, axis=-1)] -= 1
+        increment = (values >= np.take_along_axis(bin_edges, indices + 1, axis=-1)) & (indices != n_bins - 1)
+        indices[increment] += 1
+
+        return indices
+
+
+    def compute_batch_channel_stats(self, X):
+
+        '''
+        Computes mean and std div for the channel values of a batch of images
+
+        Returns
+        -------
+        (numpy.ndarray (3D)) : channel stats (n_images, n_channels, 2)
+        '''
+
+        values = X.reshape(X.shape[0], -1, X.shape[-1])
+        return np.stack([np.mean(values, axis=1) / self.color_max_value, 
+                         np.std(values, axis=1) / self.color_max_value], axis=-1)
+
+
+class IntegralHistogram():
+
+    ''' 
+    Integral histograms (quantized color values and LBP codes) of an image
+    Gives the feature vector of any rectangle of the image in O(bins) time
+    '''
+
+    def __init__(self, image, feature_extractor):
+
+        '''
+        Parameters
+        ----------
+        image (numpy.ndarray) : image in 3D color space (RBG or HSV)
+        feature_extractor (FeatureComputer) : extractor defining the features (with a "full" histogram range)
+        '''
+
+        if feature_extractor.channel_hist_range != "full":
+            raise ValueError("Integral histograms require a \"full\" channel histogram range")
+
+        self.feature_extractor = feature_extractor
+        n_hist_bins = feature_extractor.channel_hist_n_bins
+        n_lbp_bins = feature_extractor.lbp_n_points + 2
+
+        # quantizing the color values of every channel
+        channel_values = image.reshape(1, -1, image.shape[-1]).astype(np.float64)
+        channel_values = np.moveaxis(channel_values, -1, 1)[0]
+        bin_indices = feature_extractor.compute_bin_indices(channel_values, 
+            np.zeros(channel_values.shape[0]), np.full(channel_values.shape[0], float(feature_extractor.color_max_value)))
+        bin_indices = np.moveaxis(bin_indices, 0, -1).reshape(image.shape)
+
+        # computing the LBP codes of the whole image
+        lbp_codes = feature_extractor.compute_batch_lbp_codes(feature_extractor.lbp_images(image[np.newaxis]))[0]
+        lbp_codes = np.moveaxis(lbp_codes, 0, -1)
+
+        # integrating the one-hot histograms and the channel moments
+        self.channel_hist = self.integrate(bin_indices[..., np.newaxis] == np.arange(n_hist_bins))
+        self.lbp_hist = self.integrate(lbp_codes[..., np.newaxis] == np.arange(n_lbp_bins))
+        self.channel_sum = self.integrate(image.astype(np.float64))
+        self.channel_sq_sum = self.integrate(image.astype(np.float64) ** 2)
+
+
+    def integrate(self, values):
+
+        ''' Returns the (height + 1, width + 1, ...) integral image of the provided values '''
+
+        dtype = np.float64 if values.dtype.kind == "f" else np.int32
+        integral = np.zeros((values.shape[0] + 1, values.shape[1] + 1) + values.shape[2:], dtype=dtype)
+        np.cumsum(np.cumsum(values, axis=0, dtype=dtype), axis=1, out=integral[1:, 1:])
+
+        return integral
+
+
+    def rectangle_sums(self, integral, rows, cols, height, width):
+
+        ''' Sums the integrated values over the rectangles (top left corners "rows", "cols") '''
+
+        return (integral[rows + height, cols + width] - integral[rows, cols + width] 
+                - integral[rows + height, cols] + integral[rows, cols])
+
+
+    def rectangle_features(self, rows, cols, height, width):
+
+        '''
+        Computes the feature vectors of rectangles of the image
+
+        Parameters
+        ----------
+        rows (numpy.ndarray (1D)) : top row of every rectangle
+        cols (numpy.ndarray (1D)) : left column of every rectangle
+        height (int) : height (in pixels) of the rectangles
+        width (int) : width (in pixels) of the rectangles
+
+        Returns
+        -------
+        (np.ndarray (2D)) : feature vectors (n_rectangles, n_features)
+        '''
+
+        extractor = self.feature_extractor
+        area = height * width
+
+        # normalized color and LBP histograms
+        channel_histograms = self.rectangle_sums(self.channel_hist, rows, cols, height, width) / (area + extractor.eps)
+        lbp_histograms = self.rectangle_sums(self.lbp_hist, rows, cols, height, width) / (area + extractor.eps)
+
+        # channel mean and std div from the integrated moments
+        means = self.rectangle_sums(self.channel_sum, rows, cols, height, width) / area
+        variances = self.rectangle_sums(self.channel_sq_sum, rows, cols, height, width) / area - means ** 2
+        channel_stats = np.stack([means, np.sqrt(np.maximum(variances, 0))], axis=-1) / extractor.color_max_value
+
+        return extractor.build_feature_matrix(channel_histograms, channel_stats, lbp_histograms)
@@ -1,13 +1,17 @@
 import pickle
-import cv2 as cv
 import numpy as np
 
 from sklearn import svm
-from skimage import feature
 from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import Normalizer
+from sklearn.model_selection import cross_val_predict
+from sklearn.kernel_approximation import Nystroem
 from sklearn.neighbors import KNeighborsClassifier
-from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.preprocessing import Normalizer, StandardScaler
+from sklearn.linear_model import SGDClassifier, LogisticRegression
+from sklearn.base import BaseEstimator, TransformerMixin, ClassifierMixin, clone
+
+from .data import FeatureCache
+from .features import FeatureComputer
 
 
 class Classifier():
@@ -17,6 +21,9 @@ class Classifier():
     Loading a pre-trained model and exposing a predict function
     '''
 
+    # when defined, the scoring steps are timed (LatencyRecorder)
+    latency_recorder = None
+
     def __init__(self, classfier_path):
         
         '''
@@ -41,6 +48,100 @@ class Classifier():
         return self.clf.predict(X)[0]
 
 
+    @property
+    def feature_extractor(self):
+
+        ''' Feature extraction step of the classification pipeline '''
+
+        if isinstance(self.clf, CascadeClassifier):
+            return self.clf.feature_extractor
+
+        return self.clf.steps[0][1]
+
+
+    @property
+    def min_score(self):
+
+        ''' Lowest meaningful score (score of the images rejected by a cascade, None for the other classifiers) '''
+
+        if isinstance(self.clf, CascadeClassifier):
+            return self.clf.rejected_score_
+
+        return None
+
+
+    def decision_batch(self, X):
+
+        '''
+        Scores a batch of images (signed distance to the decision boundary, positive = trunk class)
+
+        Parameters
+        ----------
+        X (numpy.ndarray (4D)) : array of images (n_images, height, width, n_channels)
+
+        Returns
+        -------
+        (numpy.ndarray (1D)) : score of every input image
+        '''
+
+        if isinstance(self.clf, CascadeClassifier):
+            return self.clf.decision_function(X)
+
+        features = self.feature_extractor.transform(X)
+        self.record_stage("features")
+
+        return self.decision_features(features)
+
+
+    def decision_features(self, features):
+
+        '''
+        Scores already extracted feature vectors (skips the feature extraction step)
+
+        Parameters
+        ----------
+        features (numpy.ndarray (2D)) : feature vectors produced by the pipeline feature extractor
+
+        Returns
+        -------
+        (numpy.ndarray (1D)) : score of every feature vector (positive = trunk class)
+        '''
+
+        if isinstance(self.clf, CascadeClassifier):
+            return self.clf.decision_features(features)
+
+        features = self.transform_intermediate(features)
+        self.record_stage("normalization")
+
+        # classifiers without decision function (KNN) are scored from their class probabilities
+        final_step = self.clf.steps[-1][1]
+        if hasattr(final_step, "decision_function"):
+            scores = final_step.decision_function(features)
+        else:
+            scores = final_step.predict_proba(features)[:, 1] - 0.5
+        self.record_stage("prediction")
+
+        return scores
+
+
+    def transform_intermediate(self, features):
+
+        ''' Applies the pipeline steps between the feature extractor and the classifier (none for KNN pipelines) '''
+
+        for _, step in self.clf.steps[1 : -1]:
+            features = step.transform(features)
+
+        return features
+
+
+    def record_stage(self, stage):
+
+        ''' Records the time elapsed since the last recorded stage (when a latency recorder is defined) '''
+
+        if self.latency_recorder is not None:
+            self.latency_recorder.lap(stage)
+
+
 class TreeClassifierKNN(Classifier):
 
     ''' 
@@ -69,7 +170,7 @@ class TreeClassifierKNN(Classifier):
                     configs_container[step_i][clean_param_name] = kwargs[config_param]
 
         return Pipeline([
-            ("feature_extractor", ImageFeatureExtractor(**configs_container[0]))
+            ("feature_extractor", ImageFeatureExtractor(**configs_container[0])),
             ("knn", KNeighborsClassifier(**configs_container[1]))
         ])
         
@@ -105,22 +206,177 @@ class TreeClassifierSVM(Classifier):
         ])
         
 
-class ImageFeatureExtractor(BaseEstimator, TransformerMixin):
+class TreeClassifierApproxSVM(Classifier):
 
     ''' 
-    Extracts features from provided images
+    Enables tree trunk classification with an approximated kernel SVM
+    The polynomial kernel is approximated by an explicit feature map followed by a linear SVM, 
+    the prediction cost does not depend on the number of support vectors
+    ''' 
+
+    pipeline_steps = ["feature_extractor", "kernel_map", "linear_model"]
+    kernel_approximations = ["nystroem", "count_sketch"]
+
+
+    @classmethod
+    def classification_pipeline(cls, kernel_approximation="nystroem", **kwargs):
+
+        ''' 
+        Returns an untrained classification pipeline
+
+        Parameters
+        ----------
+        kernel_approximation (str) : "nystroem" (Nystroem method) or "count_sketch" (polynomial count sketch)
+        '''
+
+        if not (kernel_approximation in cls.kernel_approximations):
+            raise ValueError("Invalid kernel approximation")
+
+        # preparing configuration containers
+        configs_container = []
+        for _ in range(len(cls.pipeline_steps)):
+            configs_container.append({})
+        
+        # seperating pipeline step parameters
+        for step_i, pipeline_step in enumerate(cls.pipeline_steps):
+            for config_param in kwargs.keys():
+                if pipeline_step in config_param:
+                    clean_param_name = config_param.split("__")[-1]
+                    configs_container[step_i][clean_param_name] = kwargs[config_param]
+
+        # defining the explicit feature map of the polynomial kernel
+        if kernel_approximation == "nystroem":
+            configs_container[1].setdefault("kernel", "poly")
+            configs_container[1].setdefault("degree", 3)
+            kernel_map = Nystroem(**configs_container[1])
+        else:
+            # only available in recent scikit-learn versions
+            from sklearn.kernel_approximation import PolynomialCountSketch
+            kernel_map = PolynomialCountSketch(**configs_container[1])
+
+        return Pipeline([
+            ("feature_extractor", ImageFeatureExtractor(**configs_container[0])),
+            ('normalizer', Normalizer()),
+            ("kernel_map", kernel_map),
+            ("linear_model", svm.LinearSVC(**configs_container[2]))
+        ])
+
+
+class TreeClassifierSGD(Classifier):
+
+    ''' 
+    Enables tree trunk classification with a linear SVM trained by stochastic gradient descent
+    The pipeline can be trained incrementally (mini-batches), for datasets larger than memory
+    ''' 
+
+    pipeline_steps = ["feature_extractor", "sgd"]
+
+
+    @classmethod
+    def classification_pipeline(cls, **kwargs):
+
+        ''' Returns an untrained classification pipeline'''
+
+        # preparing configuration containers
+        configs_container = []
+        for _ in range(len(cls.pipeline_steps)):
+            configs_container.append({})
+        
+        # seperating pipeline step parameters
+        for step_i, pipeline_step in enumerate(cls.pipeline_steps):
+            for config_param in kwargs.keys():
+                if pipeline_step in config_param:
+                    clean_param_name = config_param.split("__")[-1]
+                    configs_container[step_i][clean_param_name] = kwargs[config_param]
+
+        # hinge loss = linear SVM
+        configs_container[1].setdefault("loss", "hinge")
+        
+        return Pipeline([
+            ("feature_extractor", ImageFeatureExtractor(**configs_container[0])),
+            ('normalizer', Normalizer()),
+            ("sgd", SGDClassifier(**configs_container[1]))
+        ])
+
+
+    @classmethod
+    def partial_fit(cls, clf_pipeline, X, y, classes):
+
+        '''
+        Updates the classification pipeline with a mini-batch of training images
+
+        Parameters
+        ----------
+        clf_pipeline (Pipeline) : pipeline returned by "classification_pipeline"
+        X (numpy.ndarray (4D)) : mini-batch of training images
+        y (numpy.ndarray (1D)) : labels of the training images
+        classes (list(int)) : all the possible labels (required by the first update)
+        '''
+
+        # the feature extraction steps are stateless
+        features = clf_pipeline[:-1].fit_transform(X)
+        clf_pipeline.steps[-1][1].partial_fit(features, y, classes=classes)
+
+        return clf_pipeline
+
+
+class TreeClassifierCascade(Classifier):
+
+    ''' 
+    Enables tree trunk classification with a reject-early cascade
+    A linear model on the color features rejects the confident background blocks, 
+    only the remaining blocks go through the LBP extraction and the SVM
+    ''' 
+
+    pipeline_steps = ["feature_extractor", "rejection", "svm", "cascade"]
+
+
+    @classmethod
+    def classification_pipeline(cls, **kwargs):
+
+        ''' Returns an untrained cascade classifier'''
+
+        # preparing configuration containers
+        configs_container = []
+        for _ in range(len(cls.pipeline_steps)):
+            configs_container.append({})
+        
+        # seperating pipeline step parameters
+        for step_i, pipeline_step in enumerate(cls.pipeline_steps):
+            for config_param in kwargs.keys():
+                if pipeline_step in config_param:
+                    clean_param_name = config_param.split("__")[-1]
+                    configs_container[step_i][clean_param_name] = kwargs[config_param]
+
+        rejection_model = Pipeline([
+            ("scaler", StandardScaler()),
+            ("logistic", LogisticRegression(**configs_container[1]))
+        ])
+
+        classifier = Pipeline([
+            ('normalizer', Normalizer()),
+            ("svm", svm.SVC(**configs_container[2]))
+        ])
+
+        return CascadeClassifier(ImageFeatureExtractor(**configs_container[0]), rejection_model, classifier, 
+                                 **configs_container[3])
+
+
+class ImageFeatureExtractor(FeatureComputer, BaseEstimator, TransformerMixin):
+
+    ''' 
+    Extracts features from provided images (scikit-learn transformer)
     
     Features : 
         - Color histogram bins
         - LPB descriptor
     '''
-    
-    eps=1e-7
-    color_max_value = 255
-    color_spaces = ["RGB", "HSV"]
+
+    # no feature cache for the extractors pickled without one
+    cache_folder = None
     
     def __init__(self, color_space="RGB", channel_hist_n_bins=15, lbp_n_points=8, 
-                 lbp_radius=1, fusion_method=1):
+                 lbp_radius=1, fusion_method=1, channel_hist_range="block", cache_folder=None):
         
         '''
         Parameters
@@ -129,25 +385,20 @@ class ImageFeatureExtractor(BaseEstimator, TransformerMixin):
         lbp_n_points (int) : number of neighbour considered when calculating the LBP values
         fusion_method (int) : 1 or 2, fusion methods a described in the reference paper
         color_space (str) : input image color space (HSV, RBG)
+        channel_hist_range (str) : "block" = histogram bins span the value range of each image channel
+                                   "full" = histogram bins span [0, color_max_value] (required by integral histograms)
+        cache_folder (str) : when defined, the extracted features are cached in this folder 
+                             (keyed on the image content and the extractor parameters)
         '''
 
-        if not (color_space in self.color_spaces):
-            raise ValueError("Invalid color space")
-
-        if not (fusion_method == 1 or fusion_method == 2):
-            raise ValueError("Invalid fusion method") 
-
-        self.lbp_radius = lbp_radius
-        self.color_space = color_space
-        self.lbp_n_points = lbp_n_points
-        self.fusion_method = fusion_method 
-        self.channel_hist_n_bins = channel_hist_n_bins
+        super().__init__(color_space, channel_hist_n_bins, lbp_n_points, lbp_radius, fusion_method, channel_hist_range)
+        self.cache_folder = cache_folder
 
         
     def fit(self, X, y=None, **kwargs):
         return self
 
-    
+
     def transform(self, X, y=None):
 
         '''
@@ -160,84 +411,210 @@ class ImageFeatureExtractor(BaseEstimator, TransformerMixin):
         (np.ndarray (2D)) : list of feature vectors
         '''
 
-        # defining the output container
-        feature_container = None
-
-        # going through the input feature list
-        for x in X:
-
-            # isolating image color channels
-            img_channel_1 = x[..., 0]
-            img_channel_2 = x[..., 1]
-            img_channel_3 = x[..., 2]
-
-            # extracting color channel features
-            hist_vector_1 = self.compute_channel_histogram(img_channel_1)
-            hist_vector_2 = self.compute_channel_histogram(img_channel_2)
-            hist_vector_3 = self.compute_channel_histogram(img_channel_3)
-            stats_vector_1 = self.compute_channel_stats(img_channel_1)
-            stats_vector_2 = self.compute_channel_stats(img_channel_2)
-            stats_vector_3 = self.compute_channel_stats(img_channel_3)
-            feature_vector = np.concatenate([hist_vector_1, stats_vector_1, hist_vector_2, stats_vector_2,
-                                             hist_vector_3, stats_vector_3])
-
-            # extracting LBP features from gray scale image
-            if self.fusion_method == 1:
-
-                if self.color_space == "RGB":
-                    feature_vector = np.concatenate([feature_vector, 
-                                    self.compute_lbp_descriptor(cv.cvtColor(x, cv.COLOR_BGR2GRAY))])
-                else: 
-                    feature_vector = np.concatenate([feature_vector, self.compute_lbp_descriptor(img_channel_3)])
-
-            # extracting LBP features from all color channels
-            else:
-                lbp_vector_1 = self.compute_lbp_descriptor(img_channel_1)
-                lbp_vector_2 = self.compute_lbp_descriptor(img_channel_2)
-                lbp_vector_3 = self.compute_lbp_descriptor(img_channel_3)
-                feature_vector = np.concatenate([feature_vector, lbp_vector_1, lbp_vector_2, lbp_vector_3])
-
-            # adding the feature vector to the ouput container
+        X = np.asarray(X)
+
+        # reading the features from the cache when they were already extracted
+        if self.cache_folder is not None:
+
+            cache = FeatureCache(self.cache_folder)
+            features_key = self.cache_key(cache, X)
+
+            feature_container = cache.load(features_key)
             if feature_container is None:
-                feature_container = feature_vector
-            else: feature_container = np.vstack((feature_container, feature_vector))
+                feature_container = cache.save(features_key, self.extract_features(X))
 
-        # when a single feature vector is generated
-        if feature_container.ndim == 1:
-            feature_container = np.expand_dims(feature_container, axis=0)
+            return feature_container
 
-        return feature_container
+        return self.extract_features(X)
 
 
-    def compute_lbp_descriptor(self, gray_img):
+    def cache_key(self, cache, X):
 
-        ''' Computes the LBP decriptor for the provided gray scale image '''
+        ''' Returns the feature cache key of a batch of images (keyed on the content and the extractor parameters) '''
 
-        # computing the LBP histogram
-        lbp = feature.local_binary_pattern(gray_img, self.lbp_n_points, self.lbp_radius, method="uniform")
-        (hist, _) = np.histogram(lbp.ravel(), bins=np.arange(0, self.lbp_n_points + 3), 
-                                 range=(0, self.lbp_n_points + 2))
+        extractor_params = sorted((name, value) for name, value in self.get_params().items() 
+                                  if name != "cache_folder")
 
-        # normalizing the histogram
-        hist = hist.astype("float")
-        hist /= (hist.sum() + self.eps)
-        
-        return hist
+        return cache.make_key("features", extractor_params, X)
+
+
+class CascadeClassifier(BaseEstimator, ClassifierMixin):
 
+    ''' 
+    Two stage reject-early classifier (binary classification)
+
+    Stage 1 : linear model on the color features (channel histograms and stats), the images scoring 
+              under the rejection threshold are classified as background without further processing
+    Stage 2 : classifier on the full feature vectors (color and LBP features) of the remaining images
+    '''
 
-    def compute_channel_histogram(self, channel_img):
+    def __init__(self, feature_extractor=None, rejection_model=None, classifier=None, 
+                 target_recall=0.99, positive_label=1, n_threshold_folds=3):
 
-        ''' Computes a normalized value histogram for the provided single channel image '''
+        '''
+        Parameters
+        ----------
+        feature_extractor (ImageFeatureExtractor) : extractor of the feature vectors
+        rejection_model (Pipeline) : linear model of the first stage (exposing a "decision_function")
+        classifier (Pipeline) : classifier of the second stage (applied to the full feature vectors)
+        target_recall (float) : minimum ratio of positive training images passing the first stage
+        positive_label (int) : label of the objects to detect
+        n_threshold_folds (int) : number of cross validation folds used to score the training images 
+                                  when tuning the rejection threshold
+        '''
 
-        (hist, _) = np.histogram(channel_img.ravel(), bins=self.channel_hist_n_bins)
-        hist = hist.astype("float")
-        hist /= (hist.sum() + self.eps)
-        return hist
+        if not (0 < target_recall <= 1):
+            raise ValueError("Invalid target recall")
 
+        self.feature_extractor = feature_extractor
+        self.rejection_model = rejection_model
+        self.classifier = classifier
+        self.target_recall = target_recall
+        self.positive_label = positive_label
+        self.n_threshold_folds = n_threshold_folds
 
-    def compute_channel_stats(self, channel_img):
 
-        ''' Computes mean and std div for channel values '''
-        
-        return [np.mean(channel_img) / self.color_max_value, 
-                np.std(channel_img) / self.color_max_value]
\ No newline at end of file
+    def fit(self, X, y):
+
+        '''
+        Trains both stages and tunes the rejection threshold
+
+        Parameters
+        ----------
+        X (numpy.ndarray (4D)) : array of training images
+        y (numpy.ndarray (1D)) : labels of the training images
+        '''
+
+        y = np.asarray(y)
+        self.classes_ = np.unique(y)
+        if len(self.classes_) != 2 or not (self.positive_label in self.classes_):
+            raise ValueError("The cascade requires a binary problem including the positive label")
+
+        self.negative_label_ = self.classes_[self.classes_ != self.positive_label][0]
+
+        # the color features are the start of the full feature vectors (which can be cached)
+        features = self.feature_extractor.fit_transform(X)
+        color_features = features[:, : self.feature_extractor.n_color_features]
+        is_positive = y == self.positive_label
+
+        # tuning the rejection threshold on out of fold scores (not on the scores of the training images)
+        scores = cross_val_predict(clone(self.rejection_model), color_features, is_positive, 
+                                   cv=self.n_threshold_folds, method="decision_function")
+        self.rejection_threshold_ = self.compute_rejection_threshold(scores[is_positive])
+        self.rejection_model.fit(color_features, is_positive)
+
+        # training the second stage on the images it will see (on all images when the survivors are of one class)
+        survivors = scores >= self.rejection_threshold_
+        self.training_rejection_rate_ = 1 - survivors.mean()
+        if len(np.unique(y[survivors])) < 2:
+            survivors[:] = True
+        self.classifier.fit(features[survivors], y[survivors])
+
+        # score of the rejected images, below the (negative) classifier scores of the training images
+        training_scores = self.classifier_scores(features[survivors])
+        self.rejected_score_ = min(float(training_scores.min()), 0.0) - 1.0
+
+        return self
+
+
+    def compute_rejection_threshold(self, positive_scores):
+
+        ''' Returns the highest threshold keeping "target_recall" of the positive scores '''
+
+        sorted_scores = np.sort(positive_scores)
+        n_rejected = int(np.floor((1 - self.target_recall) * len(sorted_scores) + 1e-9))
+
+        return sorted_scores[min(n_rejected, len(sorted_scores) - 1)]
+
+
+    def predict(self, X):
+
+        '''
+        Parameters
+        ----------
+        X (numpy.ndarray (4D)) : array of images (n_images, height, width, n_channels)
+
+        Returns
+        -------
+        (numpy.ndarray (1D)) : predicted class for every input image
+        '''
+
+        X = np.asarray(X)
+        color_features = self.feature_extractor.extract_color_features(X)
+        survivors = self.rejection_model.decision_function(color_features) >= self.rejection_threshold_
+
+        # only extracting the LBP features of the images passing the first stage
+        predictions = np.full(X.shape[0], self.negative_label_, dtype=self.classes_.dtype)
+        if survivors.any():
+            features = self.feature_extractor.complete_color_features(color_features[survivors], X[survivors])
+            predictions[survivors] = self.classifier.predict(features)
+
+        return predictions
+
+
+    def decision_function(self, X):
+
+        '''
+        Scores images (positive = positive label), only the images passing the first stage are scored by the classifier
+        The images rejected by the first stage get a fixed score ("rejected_score_"), below the training image scores
+
+        Parameters
+        ----------
+        X (numpy.ndarray (4D)) : array of images (n_images, height, width, n_channels)
+
+        Returns
+        -------
+        (numpy.ndarray (1D)) : score of every input image
+        '''
+
+        X = np.asarray(X)
+        color_features = self.feature_extractor.extract_color_features(X)
+        survivors = self.rejection_model.decision_function(color_features) >= self.rejection_threshold_
+
+        scores = np.full(X.shape[0], self.rejected_score_)
+        if survivors.any():
+            features = self.feature_extractor.complete_color_features(color_features[survivors], X[survivors])
+            scores[survivors] = self.classifier_scores(features)
+
+        return scores
+
+
+    def decision_features(self, features):
+
+        '''
+        Scores already extracted feature vectors (see "decision_function")
+
+        Parameters
+        ----------
+        features (numpy.ndarray (2D)) : feature vectors produced by the feature extractor
+
+        Returns
+        -------
+        (numpy.ndarray (1D)) : score of every feature vector
+        '''
+
+        color_features = features[:, : self.feature_extractor.n_color_features]
+        survivors = self.rejection_model.decision_function(color_features) >= self.rejection_threshold_
+
+        scores = np.full(features.shape[0], self.rejected_score_)
+        if survivors.any():
+            scores[survivors] = self.classifier_scores(features[survivors])
+
+        return scores
+
+
+    def classifier_scores(self, features):
+
+        ''' Scores feature vectors with the second stage classifier (positive = positive label) '''
+
+        scores = self.classifier.decision_function(features)
+        return scores if self.classifier.classes_[-1] == self.positive_label else -scores
+
+
+# classifier backends selectable in the pipeline configuration
+classifier_backends = {
+    "svm" : TreeClassifierSVM,
+    "knn" : TreeClassifierKNN,
+    "approx_svm" : TreeClassifierApproxSVM,
+    "cascade" : TreeClassifierCascade
+}
@@ -1,61 +1,303 @@
 import os
+import csv
+import json
+import time
 import os.path
+from multiprocessing import shared_memory
 
 import cv2 as cv
 import numpy as np
-from .model import TreeClassifierKNN, TreeClassifierSVM
+from .features import IntegralHistogram
+from .engine import CompiledClassifier
 
 
-class DetectedObject():
+class SegmentGrid():
 
-    ''' Coordinate representation of objects in an image '''
+    ''' 
+    Detected segments of a grid of square segments (image blocks or windows of a given size)
+    The detections are a boolean grid, the pixel coordinates of a segment are derived from its grid indices
+    '''
 
-    def __init__(self, top_left, bottom_right):
+    def __init__(self, detected, rows, cols, segment_size, scores=None):
         
         '''
         Parameters
         ----------
-        top_left (int, int) : top left bounding box coordinates (row, col)
-        bottom_right (int, int) : bottom right bounding box coordinates (row, col)
+        detected (numpy.ndarray (2D)) : True for the segments classified as object segments
+        rows (numpy.ndarray (1D)) : top row (in pixels) of the segments of every grid row
+        cols (numpy.ndarray (1D)) : left column (in pixels) of the segments of every grid column
+        segment_size (int) : size (in pixels) of the square segments
+        scores (numpy.ndarray (2D)) : classifier scores of the segments (positive = object segment)
         '''
 
-        self.top_left = top_left
-        self.bottom_right = bottom_right
+        self.detected = detected
+        self.rows = rows
+        self.cols = cols
+        self.segment_size = segment_size
+        self.scores = scores
 
 
-class ImageProcessor():
+    def boxes(self):
 
-    ''' Applies the necessary processing steps for tree recognition '''
+        '''
+        Returns
+        -------
+        (numpy.ndarray (2D)) : (left col, top row, right col, bottom row) pixel box of every detected segment
+        '''
+
+        row_indices, col_indices = np.nonzero(self.detected)
+        top_rows = self.rows[row_indices]
+        left_cols = self.cols[col_indices]
+
+        return np.stack([left_cols, top_rows, left_cols + self.segment_size, top_rows + self.segment_size], axis=-1)
+
+
+    def overlay_rois(self, image):
+
+        ''' Overlays the detected segments ROIs on the image (the 1 pixel outlines of all segments are drawn at once) '''
+
+        boxes = self.boxes()
+        if len(boxes) == 0:
+            return image
+
+        # pixel coordinates of the outline of every box (same pixels as "cv.rectangle" with a thickness of 1)
+        offsets = np.arange(self.segment_size + 1)
+        left_cols, top_rows, right_cols, bottom_rows = [coords[:, np.newaxis] for coords in boxes.T]
+        outline_rows = np.concatenate([np.broadcast_to(top_rows, (len(boxes), len(offsets))), 
+                                       np.broadcast_to(bottom_rows, (len(boxes), len(offsets))),
+                                       top_rows + offsets, top_rows + offsets], axis=1).ravel()
+        outline_cols = np.concatenate([left_cols + offsets, left_cols + offsets,
+                                       np.broadcast_to(left_cols, (len(boxes), len(offsets))),
+                                       np.broadcast_to(right_cols, (len(boxes), len(offsets)))], axis=1).ravel()
+
+        # drawing the outline pixels inside of the image
+        in_image = (outline_rows < image.shape[0]) & (outline_cols < image.shape[1])
+        image[outline_rows[in_image], outline_cols[in_image]] = (0, 0, 255)
+                  
+        return image
+
+
+class DetectedTrunk():
+
+    ''' Group of connected detected segments (one obstacle) '''
+
+    def __init__(self, box, n_blocks, confidence):
+
+        '''
+        Parameters
+        ----------
+        box (tuple(int)) : (left col, top row, right col, bottom row) pixel box enclosing the segments
+        n_blocks (int) : number of detected segments in the group
+        confidence (float) : mean classifier score of the segments
+        '''
+
+        self.box = box
+        self.n_blocks = n_blocks
+        self.confidence = confidence
+
+
+    def __repr__(self):
+
+        return "DetectedTrunk(box={0}, n_blocks={1}, confidence={2:.3f})".format(self.box, self.n_blocks, self.confidence)
+
+
+class DetectionResult():
+
+    ''' 
+    Raw detection results of a frame (see "ImageProcessor.detect")
+    Drawing the results is a separate step ("render"), callers only needing the detections never pay for it
+    '''
+
+    # color and thickness of the trunk boxes
+    trunk_color = (0, 255, 0)
+    trunk_thickness = 2
+
+    def __init__(self, segment_grids, trunks, image, frame_shape, timings=None):
+
+        '''
+        Parameters
+        ----------
+        segment_grids (list(SegmentGrid)) : filtered detected segments (one grid per window size in sliding window mode)
+        trunks (list(DetectedTrunk)) : detected trunks, in original frame coordinates
+        image (numpy.ndarray) : resized frame the detections were computed on (not copied)
+        frame_shape (tuple(int)) : shape of the original frame
+        timings (dict) : stage timings (ms) and counters of the frame (when a latency recorder is defined)
+        '''
+
+        self.segment_grids = segment_grids
+        self.trunks = trunks
+        self.image = image
+        self.frame_shape = frame_shape
+        self.timings = timings
+
+
+    @property
+    def labels(self):
+
+        ''' Detected segment grid (True = object segment) of the block grid (first window size in sliding window mode) '''
+
+        return self.segment_grids[0].detected
+
+
+    @property
+    def scores(self):
+
+        ''' Classifier score grid of the block grid (first window size in sliding window mode) '''
+
+        return self.segment_grids[0].scores
+
+
+    def render(self, draw_segments=True, draw_trunks=False):
+
+        '''
+        Overlays the ROIs of the detections on the resized frame (drawn in place)
 
-    # defining the label for detected object segments
-    detected_segment_label = 1
+        Parameters
+        ----------
+        draw_segments (boolean) : True = draw the outlines of the detected segments
+        draw_trunks (boolean) : True = draw the boxes of the trunks (e.g. the tracked trunks of "TrunkTracker")
+
+        Returns
+        -------
+        numpy.ndarray : resized frame with the ROIs of the detections
+        '''
+
+        if draw_segments:
+            for segments in self.segment_grids:
+                segments.overlay_rois(self.image)
 
+        # scaling the trunk boxes back to the resized frame
+        if draw_trunks:
+            scale_x = self.image.shape[1] / self.frame_shape[1]
+            scale_y = self.image.shape[0] / self.frame_shape[0]
+            for trunk in self.trunks:
+                left, top, right, bottom = trunk.box
+                cv.rectangle(self.image, (round(left * scale_x), round(top * scale_y)), 
+                             (round(right * scale_x), round(bottom * scale_y)), self.trunk_color, self.trunk_thickness)
+
+        return self.image
+
+
+class ImageProcessor():
+
+    ''' Applies the necessary processing steps for tree recognition '''
 
-    def __init__(self, clf_path, block_size, resized_width=320, resized_height=240, debug=False):
+    def __init__(self, clf_path, block_size, resized_width=320, resized_height=240, 
+                 batch_mode=True, frame_features=False, window_stride=None, window_sizes=None, 
+                 temporal_threshold=None, decision_threshold=0.0, score_margin=None, score_smoothing=None,
+                 min_trunk_blocks=1, min_trunk_aspect_ratio=None, latency_recorder=None, debug=False):
 
         '''
         Parameters
         ----------
-        clf_path (str) : path to the pickled classifier to use
+        clf_path (str) : path to the classifier to use (pickled pipeline or compiled ".npz" classifier)
+        batch_mode (boolean) : True = classify all the image blocks with a single pipeline call
+        frame_features (boolean) : True = compute the LBP codes once for the whole resized image
+                                   (batch mode only, block borders use their true neighbors)
+        window_stride (int) : when defined, overlapping windows are classified with this stride (in pixels)
+                              from the integral histograms of the image (sliding window mode)
+        window_sizes (list(int)) : sizes (in pixels) of the square windows in sliding window mode
+                                   (defaults to the block size)
+        temporal_threshold (float) : when defined, the block scores are kept from frame to frame and only the blocks 
+                                     whose mean absolute difference with their last classified content exceeds 
+                                     this threshold are classified again (temporal mode, block grid only)
+        decision_threshold (float) : operating point, the segments scoring above it are detected 
+                                     (lower = higher recall and more false positives, 0 = classifier decision)
+        score_margin (float) : when defined (temporal mode), the change needed to classify a block again grows with the 
+                               distance of its score to the decision threshold (doubled at "score_margin" from it)
+        score_smoothing (float) : when defined, the detections use an exponential moving average of the block scores,
+                                  this value being the weight of the current frame (block grid only, 1 = no smoothing)
+        min_trunk_blocks (int) : minimum number of connected detected segments of a trunk
+        min_trunk_aspect_ratio (float) : when defined, the trunks whose height / width ratio (in segments) is 
+                                         below this value are discarded (trunks are vertical runs of segments)
+        latency_recorder (LatencyRecorder) : when defined, the stage timings and block counts of every frame are recorded
         '''
 
         self.debug = debug
+        self.batch_mode = batch_mode
+        self.frame_features = frame_features
+        self.window_stride = window_stride
+        self.window_sizes = window_sizes if window_sizes is not None else [block_size]
+        self.temporal_threshold = temporal_threshold
+        self.decision_threshold = decision_threshold
+        self.score_margin = score_margin
+        self.score_smoothing = score_smoothing
+        self.min_trunk_blocks = min_trunk_blocks
+        self.min_trunk_aspect_ratio = min_trunk_aspect_ratio
         self.block_size = block_size
         self.resized_width = resized_width
         self.resized_height = resized_height
 
+        if score_margin is not None and score_margin <= 0:
+            raise ValueError("Invalid score margin")
+        if score_smoothing is not None and not 0 < score_smoothing <= 1:
+            raise ValueError("Invalid score smoothing factor")
+
         # defining pixels increments
         self.n_blocks_col = self.resized_width // self.block_size
         self.n_blocks_row = self.resized_height // self.block_size
 
-        # defining classifier for object recognition
-        self.clf = TreeClassifierSVM(clf_path)
+        # defining classifier for object recognition (compiled classifiers do not load scikit-learn)
+        if clf_path.endswith(CompiledClassifier.file_extension):
+            self.clf = CompiledClassifier(clf_path)
+        else:
+            from .model import TreeClassifierSVM
+            self.clf = TreeClassifierSVM(clf_path)
+
+        # a threshold under the score of the blocks rejected by a cascade would detect them without classification
+        min_score = getattr(self.clf, "min_score", None)
+        if min_score is not None and decision_threshold <= min_score:
+            raise ValueError("Decision threshold below the classifier minimum score")
+
+        # the classifier records the timings of its own steps
+        self.latency_recorder = latency_recorder
+        self.clf.latency_recorder = latency_recorder
+
+        # defining the temporal mode state
+        self.reset_temporal_state()
+
+
+    def reset_temporal_state(self):
+
+        ''' Forgets the cached and smoothed block scores (e.g. before processing a new video) '''
+
+        self.reference_frame = None
+        self.cached_scores = None
+        self.smoothed_scores = None
+
+
+    def detect_object_segments(self, image, return_trunks=False):
+
+        '''
+        Detects the object segments of an image and overlays their ROIs
+
+        Parameters
+        ------
+        image (numpy.ndarray) : Image in 3D color space (RBG or HSV)
+        return_trunks (boolean) : True = also return the trunks (groups of connected detected segments)
+        
+        Returns
+        -------
+        numpy.ndarray : resized image with the ROIs of the detected segments
+        list(DetectedTrunk) : detected trunks, in original image coordinates (only when "return_trunks" is True)
+        '''
+
+        detection = self.detect(image)
+        image = detection.render()
+
+        if self.debug:
+            cv.imshow("Detected segments", image)  
+            cv.waitKey(0)
+
+        if return_trunks:
+            return image, detection.trunks
+        return image
 
 
-    def detect_object_segments(self, image):
+    def detect(self, image):
 
         '''
-        Returns image segments classified as object segments
+        Detects the object segments and the trunks of an image, without drawing them
 
         Parameters
         ------
@@ -63,15 +305,211 @@ class ImageProcessor():
         
         Returns
         -------
-        list(list(DetectedObject / None)) : 2D list of detected objects
+        DetectionResult : detected segments, trunks (in original image coordinates) and stage timings
         '''
 
+        if self.latency_recorder is not None:
+            self.latency_recorder.start_frame()
+
         # resizing the input image
+        frame_height, frame_width = image.shape[: 2]
         image = cv.resize(image, (self.resized_width, self.resized_height), 
                           interpolation = cv.INTER_AREA)
+        self.record_stage("resize")
+
+        # classifying overlapping windows of every size
+        if self.window_stride is not None:
+            segment_grids = self.detect_windows(image)
+
+        # classifying the blocks of the input image
+        else:
+            if self.temporal_threshold is not None:
+                block_scores = self.classify_blocks_temporal(image)
+            elif self.batch_mode:
+                block_scores = self.classify_blocks(image)
+            else:
+                block_scores = self.classify_blocks_sequential(image)
+            if self.score_smoothing is not None:
+                block_scores = self.smooth_scores(block_scores)
+            self.record_stage("classification")
+
+            object_segments = self.build_segments(block_scores, np.arange(self.n_blocks_row) * self.block_size, 
+                                                  np.arange(self.n_blocks_col) * self.block_size, self.block_size)
+            self.record_count("blocks_flagged", np.count_nonzero(object_segments.detected))
+            self.record_stage("segments")
+
+            # filtering the detected segments 
+            segment_grids = [self.filter_segments(object_segments)]
+            self.record_stage("filtering")
+
+        # grouping the connected segments into trunks (boxes scaled to the original image)
+        trunks = [trunk for object_segments in segment_grids for trunk in self.group_trunks(object_segments)]
+        scale_x, scale_y = frame_width / self.resized_width, frame_height / self.resized_height
+        for trunk in trunks:
+            left, top, right, bottom = trunk.box
+            trunk.box = (round(left * scale_x), round(top * scale_y), round(right * scale_x), round(bottom * scale_y))
+        self.record_stage("grouping")
+        self.record_count("trunks", len(trunks))
+
+        timings = None
+        if self.latency_recorder is not None:
+            timings = self.latency_recorder.end_frame()
+
+        return DetectionResult(segment_grids, trunks, image, (frame_height, frame_width), timings)
+
+
+    def record_stage(self, stage):
+
+        ''' Records the time elapsed since the last recorded stage (when a latency recorder is defined) '''
+
+        if self.latency_recorder is not None:
+            self.latency_recorder.lap(stage)
+
+
+    def record_count(self, counter, value):
+
+        ''' Adds a value to a per frame counter (when a latency recorder is defined) '''
+
+        if self.latency_recorder is not None:
+            self.latency_recorder.count(counter, value)
+
+
+    def extract_blocks(self, image):
+
+        '''
+        Tiles the resized image into its grid of blocks
+
+        Parameters
+        ----------
+        image (numpy.ndarray) : resized image in 3D color space (RBG or HSV)
+
+        Returns
+        -------
+        (numpy.ndarray (4D)) : image blocks (n_blocks, block_size, block_size, n_channels), in row major order
+        '''
+
+        # building a (n_blocks_row, n_blocks_col, block_size, block_size, n_channels) view of the image
+        row_stride, col_stride, channel_stride = image.strides
+        block_view = np.lib.stride_tricks.as_strided(image, 
+            shape=(self.n_blocks_row, self.n_blocks_col, self.block_size, self.block_size, image.shape[2]),
+            strides=(row_stride * self.block_size, col_stride * self.block_size, 
+                     row_stride, col_stride, channel_stride),
+            writeable=False)
+
+        return block_view.reshape(-1, self.block_size, self.block_size, image.shape[2])
+
+
+    def classify_blocks(self, image):
+
+        '''
+        Classifies all the blocks of the resized image with a single pipeline call
+
+        Parameters
+        ----------
+        image (numpy.ndarray) : resized image in 3D color space (RBG or HSV)
+
+        Returns
+        -------
+        (numpy.ndarray (2D)) : classifier score grid (n_blocks_row, n_blocks_col)
+        '''
+
+        self.record_count("blocks_classified", self.n_blocks_row * self.n_blocks_col)
+
+        if self.frame_features:
+            features = self.clf.feature_extractor.transform_frame(image, self.block_size)
+            self.record_stage("features")
+            scores = self.clf.decision_features(features)
+        else:
+            scores = self.clf.decision_batch(self.extract_blocks(image))
+
+        return scores.reshape(self.n_blocks_row, self.n_blocks_col)
+
+
+    def classify_blocks_temporal(self, image):
+
+        '''
+        Classifies only the blocks whose content changed since they were last classified
+        The scores of the other blocks are reused from the previous frames
+
+        Parameters
+        ----------
+        image (numpy.ndarray) : resized image in 3D color space (RBG or HSV)
+
+        Returns
+        -------
+        (numpy.ndarray (2D)) : classifier score grid (n_blocks_row, n_blocks_col)
+        '''
+
+        # classifying all the blocks of the first frame
+        if self.cached_scores is None:
+            self.cached_scores = self.classify_blocks(image)
+            self.reference_frame = image.copy()
+            return self.cached_scores.copy()
+
+        # computing the block-wise mean absolute difference with the last classified content
+        grid_height = self.n_blocks_row * self.block_size
+        grid_width = self.n_blocks_col * self.block_size
+        frame_diff = cv.absdiff(image[: grid_height, : grid_width], self.reference_frame[: grid_height, : grid_width])
+        block_diff = frame_diff.reshape(self.n_blocks_row, self.block_size, self.n_blocks_col, self.block_size, -1)
+        block_diff = block_diff.mean(axis=(1, 3, 4))
+
+        # classifying the changed blocks and updating their reference content
+        # (the blocks far from the decision threshold need larger changes to be classified again)
+        if self.score_margin is not None:
+            threshold_distances = np.abs(self.cached_scores - self.decision_threshold)
+            changed_blocks = block_diff > self.temporal_threshold * (1 + threshold_distances / self.score_margin)
+        else:
+            changed_blocks = block_diff > self.temporal_threshold
+        self.record_count("blocks_classified", np.count_nonzero(changed_blocks))
+        if changed_blocks.any():
+            blocks = self.extract_blocks(image)[changed_blocks.ravel()]
+            self.cached_scores[changed_blocks] = self.clf.decision_batch(blocks)
+            pixel_mask = np.repeat(np.repeat(changed_blocks, self.block_size, axis=0), self.block_size, axis=1)
+            self.reference_frame[: grid_height, : grid_width][pixel_mask] = image[: grid_height, : grid_width][pixel_mask]
+
+        return self.cached_scores.copy()
+
+
+    def smooth_scores(self, block_scores):
+
+        '''
+        Updates the exponential moving average of the block scores with the scores of the current frame
+
+        Parameters
+        ----------
+        block_scores (numpy.ndarray (2D)) : classifier score grid of the current frame
+
+        Returns
+        -------
+        (numpy.ndarray (2D)) : smoothed score grid (n_blocks_row, n_blocks_col)
+        '''
+
+        if self.smoothed_scores is None:
+            self.smoothed_scores = block_scores.astype(np.float64)
+        else:
+            self.smoothed_scores *= 1 - self.score_smoothing
+            self.smoothed_scores += self.score_smoothing * block_scores
+
+        return self.smoothed_scores.copy()
+
+
+    def classify_blocks_sequential(self, image):
+
+        '''
+        Classifies the blocks of the resized image one pipeline call at a time
+
+        Parameters
+        ----------
+        image (numpy.ndarray) : resized image in 3D color space (RBG or HSV)
+
+        Returns
+        -------
+        (numpy.ndarray (2D)) : classifier score grid (n_blocks_row, n_blocks_col)
+        '''
+
+        block_scores = np.zeros((self.n_blocks_row, self.n_blocks_col))
+        self.record_count("blocks_classified", self.n_blocks_row * self.n_blocks_col)
 
-        object_segments = [[None] * self.n_blocks_col for i in range(self.n_blocks_row)]
-        
         # going through the blocks of the input image
         for row_i in range(self.n_blocks_row):
             seg_row_start = row_i * self.block_size
@@ -82,23 +520,71 @@ class ImageProcessor():
                 image_seg = image[seg_row_start : seg_row_start + self.block_size, seg_col_start : seg_col_start + self.block_size]
                 image_seg = np.expand_dims(image_seg, axis=0)
 
-                # collecting object segments
-                if self.clf.predict(image_seg) == self.detected_segment_label:
-                    seg_top_left = (seg_col_start, seg_row_start)
-                    seg_bottom_right = (seg_col_start + self.block_size, seg_row_start + self.block_size)
-                    object_segments[row_i][col_i] = DetectedObject(seg_top_left, seg_bottom_right)
+                block_scores[row_i, col_i] = self.clf.decision_batch(image_seg)[0]
 
-        # filtering the detected segments 
-        object_segments = self.filter_segments(object_segments)
+        return block_scores
 
-        # adding detection overlay
-        image = self.overlay_segment_rois(image, object_segments)
 
-        if self.debug:
-            cv.imshow("Detected segments", image)  
-            cv.waitKey(0)
+    def detect_windows(self, image):
 
-        return image
+        '''
+        Classifies overlapping windows of the resized image (sliding window mode)
+        The features of every window are obtained from the integral histograms of the image
+
+        Parameters
+        ----------
+        image (numpy.ndarray) : resized image in 3D color space (RBG or HSV)
+
+        Returns
+        -------
+        list(SegmentGrid) : filtered detected segments, for every window size
+        '''
+
+        integral_hist = IntegralHistogram(image, self.clf.feature_extractor)
+        self.record_stage("integral_histograms")
+
+        segment_grids = []
+        for window_size in self.window_sizes:
+
+            # defining the window positions
+            window_rows = np.arange(0, self.resized_height - window_size + 1, self.window_stride)
+            window_cols = np.arange(0, self.resized_width - window_size + 1, self.window_stride)
+            grid_rows, grid_cols = np.meshgrid(window_rows, window_cols, indexing="ij")
+
+            # classifying all the windows of the current size
+            features = integral_hist.rectangle_features(grid_rows.ravel(), grid_cols.ravel(), window_size, window_size)
+            self.record_stage("features")
+            window_scores = self.clf.decision_features(features).reshape(grid_rows.shape)
+            self.record_stage("classification")
+
+            object_segments = self.build_segments(window_scores, window_rows, window_cols, window_size)
+            self.record_count("blocks_classified", window_scores.size)
+            self.record_count("blocks_flagged", np.count_nonzero(object_segments.detected))
+            self.record_stage("segments")
+            segment_grids.append(self.filter_segments(object_segments))
+            self.record_stage("filtering")
+
+        return segment_grids
+
+
+    def build_segments(self, scores, rows, cols, segment_size):
+
+        '''
+        Converts a grid of classifier scores to a grid of detected segments (scores above the decision threshold)
+
+        Parameters
+        ----------
+        scores (numpy.ndarray (2D)) : classifier score grid
+        rows (numpy.ndarray (1D)) : top row (in pixels) of the segments of every grid row
+        cols (numpy.ndarray (1D)) : left column (in pixels) of the segments of every grid column
+        segment_size (int) : size (in pixels) of the square segments
+
+        Returns
+        -------
+        SegmentGrid : detected segments
+        '''
+
+        return SegmentGrid(scores > self.decision_threshold, rows, cols, segment_size, scores=scores)
 
 
     def filter_segments(self, segments):
@@ -108,54 +594,508 @@ class ImageProcessor():
         
         Parameters
         ----------
-        segments (list(list(DetectedObject / None))) : image segments to be filtered
+        segments (SegmentGrid) : detected segments to be filtered
         
         Returns
         -------
-        (list(list(DetectedObject / None))) : filtered segments
+        SegmentGrid : filtered segments (filtered in place)
+        '''
+
+        detected = segments.detected
+
+        # removing detected segments with no direct neighbors (neighbor grids obtained by shifting the grid)
+        has_neighbor = np.zeros_like(detected)
+        has_neighbor[1:, :] |= detected[:-1, :]
+        has_neighbor[:-1, :] |= detected[1:, :]
+        has_neighbor[:, 1:] |= detected[:, :-1]
+        has_neighbor[:, :-1] |= detected[:, 1:]
+        detected &= has_neighbor
+
+        return segments
+
+
+    def group_trunks(self, segments):
+
+        '''
+        Groups the connected (4-connectivity) detected segments into trunks
+
+        Parameters
+        ----------
+        segments (SegmentGrid) : filtered detected segments
+
+        Returns
+        -------
+        list(DetectedTrunk) : detected trunks (enclosing pixel box, number of segments and mean score)
         '''
 
-        # removing detected segments with no direct neighbors
+        if not segments.detected.any():
+            return []
 
-        # going through segment grid
-        for col_i in range(self.n_blocks_col):
-            for row_i in range(self.n_blocks_row):
-                
-                has_neighbor = False
+        n_labels, component_labels, stats, _ = cv.connectedComponentsWithStats(
+            segments.detected.astype(np.uint8), connectivity=4)
+        if n_labels == 1:
+            return []
 
-                # checking for direct neighbors
-    
-                if row_i > 0 :
-                    if segments[row_i - 1][col_i] is not None:
-                        has_neighbor = True
+        # mean score of every component (label 0 = background)
+        n_blocks = stats[1:, cv.CC_STAT_AREA]
+        if segments.scores is not None:
+            score_sums = np.bincount(component_labels.ravel(), weights=segments.scores.ravel(), minlength=n_labels)
+            confidences = score_sums[1:] / n_blocks
+        else:
+            confidences = np.full(n_labels - 1, np.nan)
 
-                if row_i < (self.n_blocks_row - 1):
-                    if segments[row_i + 1][col_i] is not None:
-                        has_neighbor = True
+        trunks = []
+        for (left, top, width, height, area), confidence in zip(stats[1:], confidences):
 
-                if col_i > 0 :
-                    if segments[row_i][col_i - 1] is not None:
-                        has_neighbor = True
-            
-                if col_i < (self.n_blocks_col - 1):
-                    if segments[row_i][col_i + 1] is not None:
-                        has_neighbor = True
+            # discarding the small groups and the groups not shaped as trunks
+            if area < self.min_trunk_blocks:
+                continue
+            if self.min_trunk_aspect_ratio is not None and height < self.min_trunk_aspect_ratio * width:
+                continue
 
-                # removing segments with no neighbors
-                if not has_neighbor:
-                    segments[row_i][col_i] = None
+            box = (int(segments.cols[left]), int(segments.rows[top]), 
+                   int(segments.cols[left + width - 1]) + segments.segment_size, 
+                   int(segments.rows[top + height - 1]) + segments.segment_size)
+            trunks.append(DetectedTrunk(box, int(area), float(confidence)))
 
-        return segments
+        return trunks
 
 
     def overlay_segment_rois(self, image, segments):
 
-        ''' Overlay detected segments ROIs on source image '''
+        ''' Overlay detected segments ROIs on source image (see "SegmentGrid.overlay_rois") '''
 
-        for row_i in range(self.n_blocks_row):
-            for col_i in range(self.n_blocks_col):
-                if segments[row_i][col_i] is not None:
-                    image = cv.rectangle(image, segments[row_i][col_i].top_left, 
-                                         segments[row_i][col_i].bottom_right, (0, 0, 255), 1)                                
-                  
-        return image
\ No newline at end of file
+        return segments.overlay_rois(image)
+
+
+class TrackedTrunk(DetectedTrunk):
+
+    ''' Trunk followed from frame to frame (see "TrunkTracker") '''
+
+    def __init__(self, track_id, trunk):
+
+        '''
+        Parameters
+        ----------
+        track_id (int) : identifier of the track
+        trunk (DetectedTrunk) : first detection of the trunk
+        '''
+
+        super().__init__(trunk.box, trunk.n_blocks, trunk.confidence)
+        self.track_id = track_id
+        self.position = np.asarray(trunk.box, dtype=np.float64)
+        self.velocity = np.zeros(2)
+        self.n_hits = 1
+        self.n_missed = 0
+        self.n_frames_since_hit = 0
+
+
+    def __repr__(self):
+
+        return "TrackedTrunk(id={0}, box={1}, n_hits={2}, n_missed={3})".format(self.track_id, self.box, self.n_hits, 
+                                                                             self.n_missed)
+
+
+    def predict(self):
+
+        ''' Moves the box of the trunk by its velocity (one frame) '''
+
+        self.position += np.tile(self.velocity, 2)
+        self.n_frames_since_hit += 1
+        self.box = tuple(int(round(coord)) for coord in self.position)
+
+
+    def update(self, trunk):
+
+        ''' 
+        Replaces the box of the trunk by its new detection
+        The velocity is estimated from the displacement of the box center (the box size changes by whole blocks)
+        '''
+
+        detected_position = np.asarray(trunk.box, dtype=np.float64)
+        last_center = self.center(self.position) - self.velocity * self.n_frames_since_hit
+        self.velocity = (self.center(detected_position) - last_center) / max(self.n_frames_since_hit, 1)
+        self.position = detected_position
+        self.box, self.n_blocks, self.confidence = trunk.box, trunk.n_blocks, trunk.confidence
+        self.n_hits += 1
+        self.n_missed = 0
+        self.n_frames_since_hit = 0
+
+
+    def center(self, position):
+
+        ''' Returns the (col, row) center of a box '''
+
+        return (position[:2] + position[2:]) / 2
+
+
+class TrunkTracker():
+
+    ''' 
+    Follows the trunks detected by an image processor across frames
+    The detections are associated to the tracks by box overlap (IoU), a track survives a few missed detections
+    Only every "detection_interval" frame is classified, the boxes of the other frames are extrapolated from the
+    track velocities (the segment grids are those of the last classified frame, the tracked boxes are drawn with
+    "render(draw_segments=False, draw_trunks=True)")
+    '''
+
+    def __init__(self, processor, detection_interval=1, iou_threshold=0.3, max_missed=2, min_hits=1):
+
+        '''
+        Parameters
+        ----------
+        processor (ImageProcessor) : image processor detecting the trunks
+        detection_interval (int) : number of frames between classified frames (1 = every frame is classified)
+        iou_threshold (float) : minimum box IoU between a track and a detection of the same trunk
+        max_missed (int) : number of consecutive missed detections after which a track is dropped
+        min_hits (int) : number of detections before a track is reported
+        '''
+
+        if detection_interval < 1:
+            raise ValueError("Invalid detection interval")
+        if not 0 < iou_threshold <= 1:
+            raise ValueError("Invalid IoU threshold")
+
+        self.processor = processor
+        self.detection_interval = detection_interval
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.min_hits = min_hits
+        self.reset()
+
+
+    def reset(self):
+
+        ''' Drops all the tracks and the processor temporal state (e.g. before processing a new video) '''
+
+        self.tracks = []
+        self.next_track_id = 0
+        self.frame_i = 0
+        self.last_detection = None
+        self.processor.reset_temporal_state()
+
+
+    def update(self, image):
+
+        '''
+        Processes the next frame
+
+        Parameters
+        ----------
+        image (numpy.ndarray) : Image in 3D color space (RBG or HSV)
+
+        Returns
+        -------
+        DetectionResult : detected segments (last classified frame) and reported tracks (TrackedTrunk) of the frame
+        '''
+
+        for track in self.tracks:
+            track.predict()
+
+        # classifying the frame and associating its trunks to the tracks
+        if self.frame_i % self.detection_interval == 0:
+            self.last_detection = self.processor.detect(image)
+            self.associate(self.last_detection.trunks)
+            segment_grids, timings = self.last_detection.segment_grids, self.last_detection.timings
+            resized_image = self.last_detection.image
+
+        # keeping the segments of the last classified frame (the frame is only resized for rendering)
+        else:
+            segment_grids, timings = self.last_detection.segment_grids, None
+            resized_image = cv.resize(image, (self.processor.resized_width, self.processor.resized_height), 
+                                      interpolation = cv.INTER_AREA)
+
+        self.frame_i += 1
+        tracks = [track for track in self.tracks if track.n_hits >= self.min_hits]
+
+        return DetectionResult(segment_grids, tracks, resized_image, image.shape[: 2], timings)
+
+
+    def associate(self, trunks):
+
+        '''
+        Matches the detected trunks to the tracks (greedy, highest IoU first)
+        The unmatched trunks start new tracks, the tracks missing too many detections are dropped
+
+        Parameters
+        ----------
+        trunks (list(DetectedTrunk)) : trunks detected in the current frame
+        '''
+
+        matched_tracks, matched_trunks = set(), set()
+        if self.tracks and trunks:
+            ious = self.compute_ious(np.array([track.position for track in self.tracks]),
+                                     np.array([trunk.box for trunk in trunks], dtype=np.float64))
+            for track_i, trunk_i in zip(*np.unravel_index(np.argsort(-ious, axis=None), ious.shape)):
+                if ious[track_i, trunk_i] < self.iou_threshold:
+                    break
+                if track_i in matched_tracks or trunk_i in matched_trunks:
+                    continue
+                self.tracks[track_i].update(trunks[trunk_i])
+                matched_tracks.add(track_i)
+                matched_trunks.add(trunk_i)
+
+        # updating the missed tracks and starting the new ones
+        for track_i, track in enumerate(self.tracks):
+            if track_i not in matched_tracks:
+                track.n_missed += 1
+        self.tracks = [track for track in self.tracks if track.n_missed <= self.max_missed]
+
+        for trunk_i, trunk in enumerate(trunks):
+            if trunk_i not in matched_trunks:
+                self.tracks.append(TrackedTrunk(self.next_track_id, trunk))
+                self.next_track_id += 1
+
+
+    def compute_ious(self, boxes_a, boxes_b):
+
+        '''
+        Computes the intersection over union of every pair of boxes
+
+        Returns
+        -------
+        (numpy.ndarray (2D)) : IoU values (len(boxes_a), len(boxes_b))
+        '''
+
+        left_top = np.maximum(boxes_a[:, np.newaxis, :2], boxes_b[np.newaxis, :, :2])
+        right_bottom = np.minimum(boxes_a[:, np.newaxis, 2:], boxes_b[np.newaxis, :, 2:])
+        intersections = np.prod(np.clip(right_bottom - left_top, 0, None), axis=-1)
+
+        areas_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=-1)
+        areas_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=-1)
+        unions = areas_a[:, np.newaxis] + areas_b[np.newaxis, :] - intersections
+
+        return intersections / np.maximum(unions, 1e-9)
+
+
+class SharedFrameBuffer():
+
+    ''' 
+    Ring buffer of fixed size frame slots in shared memory
+    Processes write and read the frames in place, only slot indices need to be exchanged
+    '''
+
+    def __init__(self, n_slots, frame_height, frame_width, n_channels=3, name=None):
+
+        '''
+        Parameters
+        ----------
+        n_slots (int) : number of frame slots in the ring
+        frame_height (int) : height (in pixels) of the frames (ImageProcessor.resized_height)
+        frame_width (int) : width (in pixels) of the frames (ImageProcessor.resized_width)
+        n_channels (int) : number of color channels of the frames
+        name (str) : name of an existing buffer to attach to (a new buffer is created when None)
+        '''
+
+        self.n_slots = n_slots
+        self.frame_shape = (frame_height, frame_width, n_channels)
+        self.is_owner = name is None
+
+        # creating (or attaching to) the shared memory block
+        buffer_size = n_slots * frame_height * frame_width * n_channels
+        self.shared_mem = shared_memory.SharedMemory(name=name, create=self.is_owner, size=buffer_size)
+        self.frames = np.ndarray((n_slots,) + self.frame_shape, dtype=np.uint8, buffer=self.shared_mem.buf)
+
+
+    @property
+    def name(self):
+
+        ''' Name used by other processes to attach to the buffer '''
+
+        return self.shared_mem.name
+
+
+    def attach_args(self):
+
+        ''' Returns the arguments needed to attach to the buffer from another process '''
+
+        return (self.n_slots,) + self.frame_shape + (self.name,)
+
+
+    def write(self, slot, frame):
+
+        ''' Resizes (if needed) the provided frame directly into the slot '''
+
+        slot_frame = self.frames[slot % self.n_slots]
+        if frame.shape == self.frame_shape:
+            slot_frame[...] = frame
+        else:
+            cv.resize(frame, (self.frame_shape[1], self.frame_shape[0]), dst=slot_frame, interpolation=cv.INTER_AREA)
+
+
+    def read(self, slot):
+
+        ''' Returns the frame of the slot (view on the shared memory, no copy) '''
+
+        return self.frames[slot % self.n_slots]
+
+
+    def close(self):
+
+        ''' Releases the buffer (the shared memory block is destroyed by the owner) '''
+
+        self.frames = None
+        self.shared_mem.close()
+        if self.is_owner:
+            self.shared_mem.unlink()
+
+
+class LatencyRecorder():
+
+    ''' 
+    Records the per stage timings (in milliseconds) and the counters of the processed frames in a ring buffer
+    Only the "capacity" most recent frames are kept (fixed memory, no allocation per frame beyond a small dict)
+    '''
+
+    total_column = "total"
+    default_percentiles = (50, 90, 99)
+
+
+    def __init__(self, capacity=1000):
+
+        '''
+        Parameters
+        ----------
+        capacity (int) : number of frames kept in the ring buffer
+        '''
+
+        if capacity < 1:
+            raise ValueError("Invalid latency recorder capacity")
+
+        self.capacity = capacity
+        self.columns = {}
+        self.next_row = 0
+        self.n_frames = 0
+        self.frame_record = {}
+        self.frame_start = None
+        self.lap_start = None
+
+
+    def start_frame(self):
+
+        ''' Starts the timing of a new frame '''
+
+        self.frame_record = {}
+        self.frame_start = self.lap_start = time.perf_counter()
+
+
+    def lap(self, stage):
+
+        ''' Adds the time elapsed since the last lap (or the frame start) to the stage timing of the frame '''
+
+        lap_end = time.perf_counter()
+        self.frame_record[stage] = self.frame_record.get(stage, 0.0) + (lap_end - self.lap_start) * 1000
+        self.lap_start = lap_end
+
+
+    def count(self, counter, value):
+
+        ''' Adds a value to a counter of the frame '''
+
+        self.frame_record[counter] = self.frame_record.get(counter, 0) + value
+
+
+    def end_frame(self):
+
+        ''' 
+        Records the timings and counters of the frame in the ring buffer
+
+        Returns
+        -------
+        dict : stage timings (ms) and counters of the frame
+        '''
+
+        self.frame_record[self.total_column] = (time.perf_counter() - self.frame_start) * 1000
+        self.add_frame(self.frame_record)
+
+        return self.frame_record
+
+
+    def add_frame(self, frame_record):
+
+        ''' 
+        Records the timings and counters of a frame (e.g. a frame processed by another process)
+
+        Parameters
+        ----------
+        frame_record (dict) : stage timings (ms) and counters of the frame (see "end_frame")
+        '''
+
+        # adding the columns of the new stages and counters
+        for name in frame_record:
+            if name not in self.columns:
+                self.columns[name] = np.full(self.capacity, np.nan)
+
+        for name, column in self.columns.items():
+            column[self.next_row] = frame_record.get(name, np.nan)
+
+        self.next_row = (self.next_row + 1) % self.capacity
+        self.n_frames = min(self.n_frames + 1, self.capacity)
+
+
+    def frame_records(self):
+
+        ''' 
+        Returns
+        -------
+        dict(numpy.ndarray (1D)) : values of every column for the recorded frames (oldest frame first)
+        '''
+
+        first_row = (self.next_row - self.n_frames) % self.capacity
+        rows = (first_row + np.arange(self.n_frames)) % self.capacity
+
+        return {name : column[rows] for name, column in self.columns.items()}
+
+
+    def percentiles(self, percentiles=default_percentiles):
+
+        ''' 
+        Computes rolling percentiles of every column over the recorded frames
+
+        Returns
+        -------
+        dict(dict(float)) : percentile values of every column (e.g. {"resize" : {"p50" : 0.4, ...}, ...})
+        '''
+
+        stats = {}
+        for name, values in self.frame_records().items():
+            values = values[~np.isnan(values)]
+            if len(values) > 0:
+                stats[name] = {"p{0}".format(q) : float(v) for q, v in zip(percentiles, np.percentile(values, percentiles))}
+
+        return stats
+
+
+    def dump_csv(self, file_path):
+
+        ''' Writes the recorded frames to a CSV file (one row per frame, oldest frame first) '''
+
+        records = self.frame_records()
+        with open(file_path, "w", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(records.keys())
+            for row_i in range(self.n_frames):
+                writer.writerow(["" if np.isnan(values[row_i]) else values[row_i] for values in records.values()])
+
+
+    def dump_json(self, file_path, percentiles=default_percentiles):
+
+        ''' Writes the rolling percentiles and the recorded frames to a JSON file '''
+
+        records = self.frame_records()
+        with open(file_path, "w") as json_file:
+            json.dump({
+                "n_frames" : self.n_frames,
+                "percentiles" : self.percentiles(percentiles),
+                "frames" : {name : [None if np.isnan(v) else float(v) for v in values] for name, values in records.items()}
+            }, json_file, indent=2)
+
+
+    def dump(self, file_path):
+
+        ''' Writes the recorded frames to a CSV or JSON file (chosen from the file extension) '''
+
+        if file_path.endswith(".json"):
+            self.dump_json(file_path)
+        else:
+            self.dump_csv(file_path)
@@ -0,0 +1,399 @@
+import os
+import json
+import math
+import time
+import os.path
+import multiprocessing
+
+import numpy as np
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import ParameterGrid, StratifiedKFold
+
+from .data import FeatureCache
+from .model import ImageFeatureExtractor
+
+
+# training data and search settings of the current worker process
+worker_state = {}
+
+
+def init_search_worker(X, y, sample_indices, clf_backend, scoring, cv, cache_folder):
+
+    ''' Stores the training data and the search settings once per worker process '''
+
+    worker_state.update(X=X, y=y, sample_indices=sample_indices, clf_backend=clf_backend, scoring=scoring,
+                        cv=cv, cache_folder=cache_folder)
+
+
+def search_samples(n_samples):
+
+    ''' Returns the images and labels of the first "n_samples" training samples (in the search sample order) '''
+
+    sample_indices = worker_state["sample_indices"]
+    if sample_indices is None:
+        return worker_state["X"][: n_samples], worker_state["y"][: n_samples]
+
+    return worker_state["X"][sample_indices[: n_samples]], worker_state["y"][sample_indices[: n_samples]]
+
+
+def extract_search_features(extraction_task):
+
+    '''
+    Extracts the features of the training images for a feature extractor configuration
+    The features are saved in the feature cache (only their cache key is sent back)
+
+    Parameters
+    ----------
+    extraction_task (dict, int) : feature extractor parameters and number of training samples to use
+    '''
+
+    extractor_params, n_samples = extraction_task
+    X, _ = search_samples(n_samples)
+
+    extractor = ImageFeatureExtractor(**{name.split("__")[-1] : value for name, value in extractor_params.items()})
+    cache = FeatureCache(worker_state["cache_folder"])
+
+    features_key = extractor.cache_key(cache, X)
+    if cache.load(features_key) is None:
+        cache.save(features_key, extractor.extract_features(X))
+
+    return extractor_params, features_key
+
+
+def evaluate_search_candidate(search_task):
+
+    '''
+    Cross validates the classification steps of a candidate on cached features
+
+    Parameters
+    ----------
+    search_task (str, dict, int) : cache key of the candidate features, the candidate parameters
+                                   and the number of training samples to use
+
+    Returns
+    -------
+    dict : candidate parameters, number of samples, test scores and fit times of every fold
+    '''
+
+    features_key, params, n_samples = search_task
+    features = FeatureCache(worker_state["cache_folder"]).load(features_key)
+    _, y = search_samples(n_samples)
+
+    # the feature extraction step is skipped (the features are already extracted)
+    clf_pipeline = worker_state["clf_backend"].classification_pipeline(**params)[1:]
+    scorer = get_scorer(worker_state["scoring"])
+
+    test_scores, fit_times = [], []
+    for train_indices, test_indices in StratifiedKFold(n_splits=worker_state["cv"]).split(np.zeros(n_samples), y):
+        start_time = time.time()
+        clf_pipeline.fit(features[train_indices], y[train_indices])
+        fit_times.append(time.time() - start_time)
+        test_scores.append(float(scorer(clf_pipeline, features[test_indices], y[test_indices])))
+
+    return {"params" : params, "n_samples" : n_samples, "test_scores" : test_scores, "fit_times" : fit_times}
+
+
+class CachedGridSearch():
+
+    '''
+    Grid search of a classification pipeline, parallelized with processes
+    The features are extracted once per feature extractor configuration (in parallel, cached on disk),
+    the classification steps of every candidate are then cross validated on the cached features across all cores
+    The results are appended to a JSON lines file as they come, an interrupted search resumes from it
+    (the results are keyed on the training data, the results of other datasets are not reused)
+    '''
+
+    extractor_prefix = "feature_extractor__"
+
+
+    def __init__(self, clf_backend, param_grid, results_path, cache_folder, scoring="recall", cv=3, n_workers=None):
+
+        '''
+        Parameters
+        ----------
+        clf_backend (Classifier class) : classifier exposing a "classification_pipeline" (feature extractor first)
+        param_grid (dict) : lists of values of the pipeline parameters (GridSearchCV format)
+        results_path (str) : path of the JSON lines file in which the candidate results are appended
+        cache_folder (str) : folder in which the extracted features are cached
+        scoring (str) : scikit-learn scorer name
+        cv (int) : number of stratified cross validation folds
+        n_workers (int) : number of worker processes (defaults to the number of cores)
+        '''
+
+        self.clf_backend = clf_backend
+        self.param_grid = param_grid
+        self.results_path = results_path
+        self.cache_folder = cache_folder
+        self.scoring = scoring
+        self.cv = cv
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+
+
+    def fit(self, X, y):
+
+        '''
+        Evaluates the candidates of the grid which are not in the results file yet
+
+        Parameters
+        ----------
+        X (numpy.ndarray (4D)) : array of training images
+        y (numpy.ndarray (1D)) : labels of the training images
+        '''
+
+        y = np.asarray(y)
+        candidates = list(ParameterGrid(self.param_grid))
+
+        with self.worker_pool(X, y) as pool:
+            results = self.evaluate_candidates(pool, candidates, len(y))
+
+        self.set_results(results, [0] * len(results))
+
+        return self
+
+
+    def worker_pool(self, X, y, sample_indices=None):
+
+        '''
+        Returns the pool of worker processes evaluating the candidates
+
+        Parameters
+        ----------
+        sample_indices (numpy.ndarray (1D)) : order of the training samples, subsamples are prefixes of it
+                                              (None = the training data order)
+        '''
+
+        # fingerprint of the training data (and of the subsample order) in the result keys
+        self.dataset_key_ = FeatureCache(self.cache_folder).make_key("dataset", np.asarray(X), y, sample_indices)
+
+        init_args = (X, y, sample_indices, self.clf_backend, self.scoring, self.cv, self.cache_folder)
+        return multiprocessing.Pool(self.n_workers, initializer=init_search_worker, initargs=init_args)
+
+
+    def evaluate_candidates(self, pool, candidates, n_samples):
+
+        '''
+        Cross validates candidates on the first "n_samples" training samples (skipping the ones in the results file)
+
+        Parameters
+        ----------
+        pool (multiprocessing.Pool) : pool returned by "worker_pool"
+        candidates (list(dict)) : parameters of the candidates
+        n_samples (int) : number of training samples to use
+
+        Returns
+        -------
+        list(dict) : results of the candidates (same order as the candidates)
+        '''
+
+        completed_results = self.load_results()
+
+        # grouping the pending candidates by feature extractor configuration
+        extractor_configs = {}
+        for params in candidates:
+            if self.result_key(params, n_samples) in completed_results:
+                continue
+            extractor_params = {name : value for name, value in params.items() if name.startswith(self.extractor_prefix)}
+            extractor_configs.setdefault(self.result_key(extractor_params), (extractor_params, []))[1].append(params)
+
+        if extractor_configs:
+
+            with open(self.results_path, "a") as results_file:
+
+                # terminating a line truncated by an interruption
+                if results_file.tell() > 0 and not self.ends_with_newline():
+                    results_file.write("\n")
+
+                def write_result(result):
+                    result["dataset"] = self.dataset_key_
+                    results_file.write(json.dumps(result) + "\n")
+                    results_file.flush()
+                    completed_results[self.result_key(result["params"], result["n_samples"])] = result
+
+                # extracting the features of every extractor configuration, the candidates of a configuration
+                # being evaluated as soon as its features are available
+                evaluations = []
+                extraction_tasks = [(extractor_params, n_samples) for extractor_params, _ in extractor_configs.values()]
+                for extractor_params, features_key in pool.imap_unordered(extract_search_features, extraction_tasks):
+                    for params in extractor_configs[self.result_key(extractor_params)][1]:
+                        evaluations.append(pool.apply_async(evaluate_search_candidate,
+                                                            ((features_key, params, n_samples),),
+                                                            callback=write_result))
+
+                # waiting for the evaluations (raising the worker errors)
+                for evaluation in evaluations:
+                    evaluation.get()
+
+        return [completed_results[self.result_key(params, n_samples)] for params in candidates]
+
+
+    def ends_with_newline(self):
+
+        ''' Checks if the last line of the results file is complete '''
+
+        with open(self.results_path, "rb") as results_file:
+            results_file.seek(-1, os.SEEK_END)
+            return results_file.read(1) == b"\n"
+
+
+    def result_key(self, params, n_samples=None):
+
+        ''' Returns a hashable representation of candidate parameters (and of the number of samples used and dataset) '''
+
+        return json.dumps([params, n_samples, self.dataset_key_], sort_keys=True)
+
+
+    def load_results(self):
+
+        '''
+        Reads the candidate results of the results file
+
+        Returns
+        -------
+        dict : candidate results by result key
+        '''
+
+        results = {}
+        if not os.path.isfile(self.results_path):
+            return results
+
+        with open(self.results_path) as results_file:
+            for line in results_file:
+
+                # skipping lines truncated by an interruption
+                try : result = json.loads(line)
+                except ValueError:
+                    continue
+
+                if result.get("dataset") == self.dataset_key_:
+                    results[self.result_key(result["params"], result["n_samples"])] = result
+
+        return results
+
+
+    def set_results(self, results, iterations):
+
+        '''
+        Assembles candidate results as the "cv_results_" of the scikit-learn searches
+        The candidates are ranked by iteration (latest first) then by mean test score
+
+        Parameters
+        ----------
+        results (list(dict)) : candidate results (see "evaluate_candidates")
+        iterations (list(int)) : search iteration of every result
+        '''
+
+        test_scores = np.array([result["test_scores"] for result in results])
+        fit_times = np.array([result["fit_times"] for result in results])
+        mean_scores = test_scores.mean(axis=1)
+        iterations = np.asarray(iterations)
+
+        # counting the results ranked before every result
+        is_ranked_before = ((iterations[np.newaxis, :] > iterations[:, np.newaxis])
+                            | ((iterations[np.newaxis, :] == iterations[:, np.newaxis])
+                               & (mean_scores[np.newaxis, :] > mean_scores[:, np.newaxis])))
+
+        candidates = [result["params"] for result in results]
+        cv_results = {
+            "params" : candidates,
+            "mean_fit_time" : fit_times.mean(axis=1),
+            "std_fit_time" : fit_times.std(axis=1),
+            "mean_test_score" : mean_scores,
+            "std_test_score" : test_scores.std(axis=1),
+            "rank_test_score" : 1 + is_ranked_before.sum(axis=1)
+        }
+
+        for split_i in range(test_scores.shape[1]):
+            cv_results["split{0}_test_score".format(split_i)] = test_scores[:, split_i]
+
+        for param_name in sorted(set(name for params in candidates for name in params)):
+            cv_results["param_" + param_name] = [params.get(param_name) for params in candidates]
+
+        best_index = int(np.argmin(cv_results["rank_test_score"]))
+        self.cv_results_ = cv_results
+        self.best_params_ = candidates[best_index]
+        self.best_score_ = mean_scores[best_index]
+
+
+class HalvingGridSearch(CachedGridSearch):
+
+    '''
+    Successive halving search of a classification pipeline
+    All the candidates are evaluated on a small subsample of the training data, only the best 1 / factor
+    of them are evaluated again on a subsample "factor" times larger, until the whole dataset is used
+    or a single candidate remains (much larger grids can be explored in the same time)
+    '''
+
+    def __init__(self, clf_backend, param_grid, results_path, cache_folder, scoring="recall", cv=3, n_workers=None,
+                 factor=3, min_resources=None, random_state=0):
+
+        '''
+        Parameters
+        ----------
+        factor (int) : candidate reduction (and subsample growth) factor between iterations
+        min_resources (int) : number of training samples of the first iteration
+                              (defaults to the size allowing the last iteration to use the whole dataset)
+        random_state (int) : seed of the training sample order (subsamples are prefixes of this order)
+        '''
+
+        super().__init__(clf_backend, param_grid, results_path, cache_folder, scoring, cv, n_workers)
+
+        if factor < 2:
+            raise ValueError("Invalid halving factor")
+
+        self.factor = factor
+        self.min_resources = min_resources
+        self.random_state = random_state
+
+
+    def fit(self, X, y):
+
+        '''
+        Evaluates the candidates on growing subsamples of the training data, keeping the best at every iteration
+
+        Parameters
+        ----------
+        X (numpy.ndarray (4D)) : array of training images
+        y (numpy.ndarray (1D)) : labels of the training images
+        '''
+
+        y = np.asarray(y)
+        candidates = list(ParameterGrid(self.param_grid))
+        n_classes = len(np.unique(y))
+
+        # defining the number of iterations and the subsample size of the first one
+        n_required_iterations = 1 + int(math.floor(math.log(len(candidates), self.factor) + 1e-9))
+        min_resources = self.min_resources
+        if min_resources is None:
+            min_resources = max(len(y) // self.factor ** (n_required_iterations - 1), 2 * self.cv * n_classes)
+        if min_resources > len(y):
+            raise ValueError("Invalid minimum number of training samples")
+
+        n_possible_iterations = 1 + int(math.floor(math.log(len(y) // min_resources, self.factor) + 1e-9))
+        n_iterations = min(n_required_iterations, n_possible_iterations)
+
+        sample_indices = np.random.RandomState(self.random_state).permutation(len(y))
+        results, iterations = [], []
+        self.n_resources_, self.n_candidates_ = [], []
+
+        with self.worker_pool(X, y, sample_indices) as pool:
+            for iteration_i in range(n_iterations):
+
+                n_samples = min(min_resources * self.factor ** iteration_i, len(y))
+                iteration_results = self.evaluate_candidates(pool, candidates, n_samples)
+
+                results += iteration_results
+                iterations += [iteration_i] * len(iteration_results)
+                self.n_resources_.append(n_samples)
+                self.n_candidates_.append(len(candidates))
+
+                # keeping the best candidates for the next iteration
+                n_kept = int(math.ceil(len(candidates) / self.factor))
+                mean_scores = np.array([np.mean(result["test_scores"]) for result in iteration_results])
+                candidates = [candidates[i] for i in np.argsort(-mean_scores, kind="stable")[: n_kept]]
+
+        self.n_iterations_ = n_iterations
+        self.set_results(results, iterations)
+        self.cv_results_["iter"] = np.asarray(iterations)
+        self.cv_results_["n_resources"] = np.array([result["n_samples"] for result in results])
+
+        return self
@@ -6,7 +6,7 @@ import os
 import os.path
 
 import cv2 as cv
-from peeptree.processing import ImageProcessor
+from peeptree.processing import ImageProcessor, LatencyRecorder
 
 if __name__ == "__main__":
 
@@ -15,9 +15,13 @@ if __name__ == "__main__":
     trained_clf_path = "classifier.pickle"
     image_dir = "/home/one_wizard_boi/Documents/Projects/DJI-tree-detection/TrainingData/OriginalImages"
 
+    # defining the stage latency dump (.csv or .json, None = no instrumentation)
+    latency_dump_path = None
+
     # defining the image processor
     color_space = "RGB"
-    processor = ImageProcessor(trained_clf_path, block_size=20, debug=True)
+    latency_recorder = LatencyRecorder() if latency_dump_path is not None else None
+    processor = ImageProcessor(trained_clf_path, block_size=20, latency_recorder=latency_recorder, debug=True)
 
     # going through the test images
     for element in os.listdir(image_dir):
@@ -31,4 +35,9 @@ if __name__ == "__main__":
                 image = cv.imread(image_path, cv.COLOR_RGB2HSV)
 
             # processing the target image
-            processor.detect_object_segments(image)
\ No newline at end of file
+            processor.detect_object_segments(image)
+
+    # exporting the stage latencies
+    if latency_recorder is not None:
+        print("Stage latency percentiles (ms) : ", latency_recorder.percentiles())
+        latency_recorder.dump(latency_dump_path)
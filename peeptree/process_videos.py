@@ -3,41 +3,148 @@ Entry point to apply trunk recognition algo to a target video
 The input video has N frames and a refresh rate R (in frames) is defined
 The recognition algo will process every R frames.
 Between every processed frame the last procesed frame will be maintained
+When more than one worker is defined, the processed frames are distributed to a pool of processes
+(the frames are exchanged through shared memory ring buffers, only slot indices go through the pool queues)
+When a temporal threshold is defined, every frame is processed, only the changed blocks being classified again
+(with a score margin, the blocks far from the decision threshold need larger changes to be classified again)
+The decision threshold sets the operating point (lower = higher recall and more false positives)
+When tracking is enabled, every frame is written with the trunks tracked across frames, only every R frames being
+classified (the block scores can also be smoothed over the classified frames)
+When a latency dump path is defined, the stage timings of every processed frame are recorded and exported
 '''
 
 import os
 import os.path
+import multiprocessing
 
 import cv2 as cv
-from peeptree.processing import ImageProcessor
+from peeptree.processing import ImageProcessor, SharedFrameBuffer, LatencyRecorder, TrunkTracker
 
 # defining necessary paths
 output_video_name = "output.mp4"
 trained_clf_path = "classifier.pickle"
 input_video_name = "drone_capture_2.mp4"
+latency_dump_path = None
 video_folder = "/home/one_wizard_boi/Documents/Projects/DJI-tree-detection/Docs/"
 
 # defining detection refresh variables
-frame_counter = 6
 detection_refresh = 5
-latest_frame = None
+temporal_threshold = None
+score_margin = None
 
-if __name__ == "__main__":
+# defining the operating point (classifier score above which a block is detected)
+decision_threshold = 0.0
 
-    # defining the image processor
-    processor = ImageProcessor(trained_clf_path, block_size=20)
+# defining the temporal smoothing variables (weight of the current frame in the block score average)
+tracking = False
+score_smoothing = None
 
-    # opening target video
-    input_video_path = os.path.join(video_folder, input_video_name)
-    input_video = cv.VideoCapture(input_video_path)
-    if not input_video.isOpened():
-        raise ValueError("Failed to load target video")
+# defining parallel processing variables
+block_size = 20
+n_workers = os.cpu_count()
+frames_per_worker = 4
 
-    # defining output video writter
-    output_video_path = os.path.join(video_folder, output_video_name)
-    output_fps = input_video.get(cv.CAP_PROP_FPS)
-    video_writter = cv.VideoWriter(output_video_path, cv.VideoWriter_fourcc(*'mp4v'),
-                                  output_fps, (processor.resized_width, processor.resized_height))
+# image processor and shared frame buffers of the current worker process
+worker_processor = None
+worker_frame_buffer = None
+worker_result_buffer = None
+
+
+def init_worker(clf_path, block_size, decision_threshold, frame_buffer_args, result_buffer_args, record_latency):
+
+    ''' Loads the pickled classifier and attaches to the shared frame buffers once per worker process '''
+
+    global worker_processor, worker_frame_buffer, worker_result_buffer
+    latency_recorder = LatencyRecorder(capacity=1) if record_latency else None
+    worker_processor = ImageProcessor(clf_path, block_size=block_size, decision_threshold=decision_threshold, 
+                                      latency_recorder=latency_recorder)
+    worker_frame_buffer = SharedFrameBuffer(*frame_buffer_args)
+    worker_result_buffer = SharedFrameBuffer(*result_buffer_args)
+
+
+def process_frame(slot):
+
+    ''' 
+    Applies recognition to the frame of a buffer slot, the result is written in the same result slot
+    The stage timings of the frame are sent back (when recorded)
+    '''
+
+    worker_result_buffer.write(slot, worker_processor.detect_object_segments(worker_frame_buffer.read(slot)))
+
+    latency_recorder = worker_processor.latency_recorder
+    return slot, (latency_recorder.frame_record if latency_recorder is not None else None)
+
+
+def read_frame_groups(input_video, n_groups):
+
+    '''
+    Reads the next groups of "detection_refresh" frames from the video
+
+    Returns
+    -------
+    list((numpy.ndarray, int)) : first frame of every group and the number of frames in the group
+    '''
+
+    frame_groups = []
+    while len(frame_groups) < n_groups:
+
+        # fetching the first frame of the group (the one to process)
+        is_frame, frame = input_video.read()
+        if not is_frame: break
+        frame_groups.append((frame, 1))
+
+        # skipping the remaining frames of the group
+        for _ in range(detection_refresh - 1):
+            if not input_video.grab(): break
+            frame_groups[-1] = (frame, frame_groups[-1][1] + 1)
+
+    return frame_groups
+
+
+def process_video_temporal(input_video, video_writter, processor):
+
+    ''' Processes every frame, reusing the labels of the unchanged blocks (the processor is in temporal mode) '''
+
+    processor.reset_temporal_state()
+
+    # going through all the frames of the video
+    while(input_video.isOpened()):
+
+        # fetching next video frame
+        is_frame, frame = input_video.read()
+        if not is_frame: break
+
+        # applying recognition with the cached block labels
+        try : video_writter.write(processor.detect_object_segments(frame))
+        except:
+            raise ValueError("Failed to process video frame")
+
+
+def process_video_tracked(input_video, video_writter, processor):
+
+    ''' Processes every frame with a trunk tracker, only every "detection_refresh" frame being classified '''
+
+    tracker = TrunkTracker(processor, detection_interval=detection_refresh)
+
+    # going through all the frames of the video
+    while(input_video.isOpened()):
+
+        # fetching next video frame
+        is_frame, frame = input_video.read()
+        if not is_frame: break
+
+        # applying recognition (or extrapolating the tracks between the classified frames)
+        try : video_writter.write(tracker.update(frame).render(draw_segments=False, draw_trunks=True))
+        except:
+            raise ValueError("Failed to process video frame")
+
+
+def process_video_sequential(input_video, video_writter, processor):
+
+    ''' Processes the sampled frames one after the other in the current process '''
+
+    frame_counter = 6
+    latest_frame = None
 
     # going through all the frames of the video
     while(input_video.isOpened()):
@@ -60,7 +167,106 @@ if __name__ == "__main__":
         # writing the latest frame to the output video
         if latest_frame is not None:
             video_writter.write(latest_frame)
-                
+
+
+def process_video_parallel(input_video, video_writter, processor):
+
+    ''' 
+    Processes the sampled frames with a pool of worker processes, writting the results in order
+    The ring buffers are split in two halves: frames are decoded in one half while the other is processed
+    '''
+
+    n_chunk_frames = n_workers * frames_per_worker
+    frame_buffer = SharedFrameBuffer(2 * n_chunk_frames, processor.resized_height, processor.resized_width)
+    result_buffer = SharedFrameBuffer(2 * n_chunk_frames, processor.resized_height, processor.resized_width)
+
+    try:
+        with multiprocessing.Pool(n_workers, initializer=init_worker, initargs=(trained_clf_path, block_size, 
+                                  processor.decision_threshold, frame_buffer.attach_args(), result_buffer.attach_args(),
+                                  processor.latency_recorder is not None)) as pool:
+
+            pending_chunk = None
+            first_slot = 0
+
+            while True:
+
+                # decoding a bounded chunk of frames directly in the free half of the frame buffer
+                frame_groups = read_frame_groups(input_video, n_chunk_frames)
+                chunk_slots = list(range(first_slot, first_slot + len(frame_groups)))
+                for slot, (frame, _) in zip(chunk_slots, frame_groups):
+                    frame_buffer.write(slot, frame)
+                processing_job = pool.map_async(process_frame, chunk_slots) if frame_groups else None
+
+                # writing the results of the previous chunk while the current one is processed
+                if pending_chunk is not None:
+                    write_chunk_results(video_writter, result_buffer, processor.latency_recorder, *pending_chunk)
+
+                if not frame_groups: break
+                pending_chunk = (processing_job, frame_groups)
+                first_slot = (first_slot + n_chunk_frames) % frame_buffer.n_slots
+
+    finally:
+        frame_buffer.close()
+        result_buffer.close()
+
+
+def write_chunk_results(video_writter, result_buffer, latency_recorder, processing_job, frame_groups):
+
+    ''' 
+    Writes the processed frames of a chunk, holding every processed frame for the duration of its group
+    The stage timings of the frames are added to the latency recorder (when defined)
+    '''
+
+    try : processed_frames = processing_job.get()
+    except:
+        raise ValueError("Failed to process video frame")
+
+    for (slot, frame_record), (_, n_group_frames) in zip(processed_frames, frame_groups):
+        if latency_recorder is not None:
+            latency_recorder.add_frame(frame_record)
+        for _ in range(n_group_frames):
+            video_writter.write(result_buffer.read(slot))
+
+
+if __name__ == "__main__":
+
+    # defining the image processor
+    latency_recorder = LatencyRecorder() if latency_dump_path is not None else None
+    processor = ImageProcessor(trained_clf_path, block_size=block_size, temporal_threshold=temporal_threshold,
+                               decision_threshold=decision_threshold, score_margin=score_margin, 
+                               score_smoothing=score_smoothing, latency_recorder=latency_recorder)
+
+    # opening target video
+    input_video_path = os.path.join(video_folder, input_video_name)
+    input_video = cv.VideoCapture(input_video_path)
+    if not input_video.isOpened():
+        raise ValueError("Failed to load target video")
+
+    # defining output video writter
+    output_video_path = os.path.join(video_folder, output_video_name)
+    output_fps = input_video.get(cv.CAP_PROP_FPS)
+    video_writter = cv.VideoWriter(output_video_path, cv.VideoWriter_fourcc(*'mp4v'),
+                                  output_fps, (processor.resized_width, processor.resized_height))
+
+    # processing every frame with the tracked trunks
+    if tracking:
+        process_video_tracked(input_video, video_writter, processor)
+
+    # processing every frame with the cached block labels
+    elif temporal_threshold is not None:
+        process_video_temporal(input_video, video_writter, processor)
+
+    # distributing the frames to the worker processes
+    elif n_workers > 1:
+        process_video_parallel(input_video, video_writter, processor)
+    else:
+        process_video_sequential(input_video, video_writter, processor)
+
     # releasing resources
     input_video.release()
-    video_writter.release()
\ No newline at end of file
+    video_writter.release()
+
+    # exporting the stage latencies
+    if latency_recorder is not None:
+        print("Stage latency percentiles (ms) : ", latency_recorder.percentiles())
+        latency_recorder.dump(latency_dump_path)
@@ -6,7 +6,8 @@ import pickle
 import os.path
 
 from peeptree.data import TrainingDataLoader
-from peeptree.model import TreeClassifierKNN, TreeClassifierSVM
+from peeptree.engine import CompiledClassifier
+from peeptree.model import TreeClassifierSGD, classifier_backends
 
 import numpy as np
 import pandas as pd
@@ -18,10 +19,18 @@ if __name__ == "__main__":
 
     # defining necessary paths
     output_model_path = "classifier.pickle"
+    compiled_model_path = "classifier.npz"
+    feature_cache_folder = "feature_cache"
     pipeline_config_path = "pipeline_params.json"
     class_definitions_path = "predefined_classes.txt"
     training_folder_prefix = "/home/one_wizard_boi/Documents/Projects/DJI-tree-detection/TrainingData/LabeledData_"
 
+    # defining the incremental training config (streamed mini-batches, for datasets larger than memory)
+    incremental_training = False
+    n_epochs = 5
+    batch_size = 256
+    buffer_size = 8192
+
     # loading the wanted pipeline parameters
     with open(pipeline_config_path) as config_file_h:
         clf_params = json.load(config_file_h)
@@ -29,23 +38,47 @@ if __name__ == "__main__":
     # setting up the loading of training data
     color_space = clf_params["feature_extractor__color_space"]
     training_folder_path = training_folder_prefix + str(clf_params["input_img_size"])
-    data_loader = TrainingDataLoader(training_folder_path, class_definitions_path, color_space=color_space)
+    data_loader = TrainingDataLoader(training_folder_path, class_definitions_path, color_space=color_space, 
+                                     cache_folder=feature_cache_folder, random_state=0)
+
+    # training the linear SVM one streamed mini-batch at a time
+    if incremental_training:
+
+        clf_pipeline = TreeClassifierSGD.classification_pipeline(**clf_params)
+        classes = sorted(data_loader.class_map.values())
+
+        for epoch_i in range(n_epochs):
+            for X_batch, y_batch in data_loader.iter_training_batches(batch_size, buffer_size, random_state=epoch_i):
+                TreeClassifierSGD.partial_fit(clf_pipeline, X_batch, y_batch, classes)
+            print("Completed training epoch : {0} / {1}".format(epoch_i + 1, n_epochs))
 
-    # defining the untrained classification pipeline
-    clf_pipeline = TreeClassifierSVM.classification_pipeline(**clf_params)
+    else:
 
-    # loading training data
-    X, y = data_loader.load_training_data()
-    training_df = pd.DataFrame({'label': y})
-    print("\nFeature set shape : ", X.shape, "\n")
-    print("Label distribution :\n", training_df["label"].value_counts(), "\n")
+        # defining the untrained classification pipeline of the configured backend (caching the extracted features)
+        clf_backend = classifier_backends[clf_params["classifier_backend"]]
+        clf_pipeline = clf_backend.classification_pipeline(feature_extractor__cache_folder=feature_cache_folder, 
+                                                           **clf_params)
 
-    # checking model performance with cross validation
-    scoring = {'accuracy': 'accuracy', 'recall': 'recall', 'precision': 'precision'}
-    cross_val_scores = cross_validate(clf_pipeline, X, y, cv=3, scoring=scoring)
-    print("cross validation scores : \n\n", cross_val_scores)
+        # loading training data
+        X, y = data_loader.load_training_data()
+        training_df = pd.DataFrame({'label': y})
+        print("\nFeature set shape : ", X.shape, "\n")
+        print("Label distribution :\n", training_df["label"].value_counts(), "\n")
 
-    # training and exporting the model
-    clf_pipeline.fit(X,y)
+        # checking model performance with cross validation
+        scoring = {'accuracy': 'accuracy', 'recall': 'recall', 'precision': 'precision'}
+        cross_val_scores = cross_validate(clf_pipeline, X, y, cv=3, scoring=scoring)
+        print("cross validation scores : \n\n", cross_val_scores)
+
+        # training the model
+        clf_pipeline.fit(X,y)
+
+    # exporting the model
+    clf_pipeline.set_params(feature_extractor__cache_folder=None)
     with open(output_model_path, 'wb') as handle:
-        pickle.dump(clf_pipeline, handle)
\ No newline at end of file
+        pickle.dump(clf_pipeline, handle)
+
+    # exporting the compiled model (pickle free NumPy inference)
+    try : CompiledClassifier.export(clf_pipeline, compiled_model_path)
+    except ValueError as error:
+        print("Compiled export skipped : ", error)